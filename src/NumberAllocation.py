@@ -1,24 +1,50 @@
-import copy
 import time
 import numpy as np
 import random
 
-from ga_utils import elitism, culling, selection
+from ga_utils import ArrayProblem, FitnessCache, GeneticAlgorithm, NullStats, Problem
+from parallel import SharedArray, WorkerPool, split_chunks, worker_state
+from checkpoint import restore_rng, rng_snapshot
 
 # Constants
 SAMPLE_SIZE = 300
 ELITISM = 75
 CULLING = 175
 MUTATION = 0.75
+CACHE_GENERATIONS = 4
+CACHE_SIZE = CACHE_GENERATIONS * SAMPLE_SIZE
+BINS = 4
 
+# Read one number per line, converting all lines in one numpy call
 def number_allocation_parser(filepath):
-    numbers = []
     with open(filepath, 'r') as f:
-        lines = f.readlines()
-        f.close()
-    for line in lines:
-        numbers.append(float(line.replace('\n', '')))
-    return numbers
+        return parse_numbers(f.read(), filepath)
+
+
+# Parse numbers from the text of an input, filepath names the input when reporting a bad line
+def parse_numbers(text, filepath='<input>'):
+    lines = [line.strip() for line in text.splitlines()]
+    try:
+        numbers = np.array([line for line in lines if line], dtype=float)
+    except ValueError:
+        # Find the offending line to report it
+        for line_num, line in enumerate(lines, 1):
+            try:
+                if line:
+                    float(line)
+            except ValueError:
+                raise ValueError("%s:%d: not a number: %r" % (filepath, line_num, line)) from None
+        raise
+    return numbers.tolist()
+
+
+# Shape of the bins holding count numbers, split evenly over the given number of bins
+def bin_shape(count, bins=BINS):
+    if bins < 3:
+        raise ValueError("at least 3 bins are needed, got %d" % bins)
+    if count == 0 or count % bins != 0:
+        raise ValueError("%d numbers cannot be split evenly into %d bins" % (count, bins))
+    return bins, count // bins
 
 
 def print_numbers(numbers):
@@ -26,32 +52,22 @@ def print_numbers(numbers):
         print(number)
 
 
-def initialize_population(list):
+def initialize_population(list, bins=BINS, size=SAMPLE_SIZE):
     population = []
+    shape = bin_shape(len(list), bins)
 
-    for i in range(SAMPLE_SIZE):
-        temp = np.array(list)
+    for i in range(size):
+        temp = np.array(list, dtype=float)
         np.random.shuffle(temp)
-        temp = temp.reshape((4, 10))
+        temp = temp.reshape(shape)
         population.append(temp)
 
     return population
 
 
-def gen_occurrence_dict(pop_list):
-    occur_dict = {}
-    for num in pop_list:
-        if num in occur_dict:
-            occur_dict[num] += 1
-        else:
-            occur_dict[num] = 1
-
-    return occur_dict
-
-
-def gen_occurrence_dict_from_bins(bins):
-    pop_list = bins.reshape(40)
-    return gen_occurrence_dict(pop_list)
+# Sorted distinct values and how often each occurs, used to repair offspring
+def gen_occurrence_arrays(pop_list):
+    return np.unique(np.asarray(pop_list, dtype=float), return_counts=True)
 
 
 # Calculate the fitness score of the bins
@@ -70,6 +86,16 @@ def fitness(bins):
     return score if score > 0 else 0
 
 
+# Cache key for a set of bins, the raw bytes of the bin array
+def bins_key(bins):
+    return np.asarray(bins).tobytes()
+
+
+# Create a fitness cache for bins
+def allocation_cache(max_size=CACHE_SIZE):
+    return FitnessCache(fitness, bins_key, max_size)
+
+
 # # Select Parents and returns the rows of the parents
 # def select_parent_rows(fitness):
 #     parents = []
@@ -94,141 +120,381 @@ def fitness(bins):
 #     return parents
 
 
-# Creates offspring of the parents
-def generate_offspring(parents: np.array, occurrences: dict):
-    offsprings = []
-
-    # Crossover sections of the parent to form the offspring
-    for index, parent in enumerate(parents):
-        offsprings.append(parent.copy())
+# Creates offspring of the parents, occurrences holds the distinct values and their counts
+def generate_offspring(parents: np.array, occurrences: tuple, stats=None):
+    if stats is None:
+        stats = NullStats()
 
-        offsprings[index][0] = parents[(index + 1) % len(parents)][0]
-        offsprings[index][2] = parents[(index + 1) % len(parents)][2]
+    # Crossover sections of the parent to form the offspring, copying the parents once
+    offsprings = np.array(parents)
+    donors = np.roll(np.arange(len(offsprings)), -1)
+    offsprings[:, 0] = offsprings[donors, 0]
+    offsprings[:, 2] = offsprings[donors, 2]
+    stats.lap('crossover')
 
     # Resolve illegal children crossover issues
-    for offspring in offsprings:
-        offspring_occurs = gen_occurrence_dict_from_bins(offspring)
-
-        # Based on how many occurrences there should in the bins
-        # determine if there are any bins that have too many numbers occurring
-        too_many_nums = []
-        too_few_nums = []
-        for value in occurrences.keys():
-            # Correct amount of occurrences are taking place for this value
-            if value in offspring_occurs and occurrences[value] == offspring_occurs[value]:
-                continue
-            # There is an incorrect number of occurrences for this value
-            else:
-                # There are zero occurrences of this value
-                if value not in offspring_occurs:
-                    offspring_occurs[value] = 0
-
-                # Determine if there is too many of the current value, or too few
-                needed_count = occurrences[value] - offspring_occurs[value]
-                curr_list = too_few_nums
-                if needed_count < 0:
-                    curr_list = too_many_nums
-
-                # Add the value to the corresponding too many/few list
-                curr_list.extend([value] * abs(needed_count))
-
-        # Resolve illegal children if there are any
-        np.random.shuffle(too_many_nums)
-        np.random.shuffle(too_few_nums)
-        while len(too_many_nums) > 0 or len(too_few_nums) > 0:
-            few_value = too_few_nums.pop()
-            many_value = too_many_nums.pop()
-
-            # Randomly select one of the values that is occurring too many times
-            many_value_indexes = np.where(offspring == many_value)
-            chosen_many_index = random.randrange(len(many_value_indexes))
-            chosen_row = many_value_indexes[0][chosen_many_index]
-            chosen_col = many_value_indexes[1][chosen_many_index]
-
-            # Replace the too many occurring value with the too few value
-            offspring[chosen_row][chosen_col] = few_value
+    stats.count('repair_swaps', repair_batch(offsprings, *occurrences))
+    stats.lap('repair')
+    return list(offsprings)
 
-    return offsprings
 
-
-def mutation(population, elites):
-    for bins in population:
+# Apply chance mutations to the sets of bins whose mask entry is set
+def mutation(population, mask, chance=MUTATION):
+    for index, bins in enumerate(population):
         mut_rand = random.random()
         # Continue if a mutation should randomly occur
-        if mut_rand < MUTATION:
+        if mut_rand < chance:
             # Skip over the elites
-            for elite in elites:
-                if np.array_equal(bins, elite):
-                    return population
-
-            # Randomly determine positions to swap two values
-            row_1, row_2 = 0, 0
-            col_1, col_2 = 0, 0
-            while row_1 == row_2:
-                row_1, row_2 = random.randrange(len(bins)), random.randrange(len(bins))
-                col_1, col_2 = random.randrange(len(bins[0])), random.randrange(len(bins[0]))
-
-            # Reassign and swap values
-            temp_val = bins[row_1][col_1]
-            bins[row_1][col_1] = bins[row_2][col_2]
-            bins[row_2][col_2] = temp_val
+            if not mask[index]:
+                continue
+            swap_values(bins)
 
     return population
 
 
-def find_best_allocation(number_list, run_time):
-    start = time.time()
-    generation = 0
+# Swap two values between different bins
+def swap_values(bins):
+    # Randomly determine positions to swap two values
+    row_1, row_2 = 0, 0
+    col_1, col_2 = 0, 0
+    while row_1 == row_2:
+        row_1, row_2 = random.randrange(len(bins)), random.randrange(len(bins))
+        col_1, col_2 = random.randrange(len(bins[0])), random.randrange(len(bins[0]))
 
-    # Generate population of bins
-    occur_map = gen_occurrence_dict(number_list)
-    population = initialize_population(number_list)
-    population.sort(key=fitness)
+    # Reassign and swap values
+    temp_val = bins[row_1][col_1]
+    bins[row_1][col_1] = bins[row_2][col_2]
+    bins[row_2][col_2] = temp_val
 
-    # Output for the program
-    best_generation = 0
-    best_population = population[len(population) - 1]
-    best_fitness = fitness(best_population)
 
-    # while generation < 20:
-    # print("Best fitness: ", best_fitness)
-    # print("Generations ran through: ", generation)
-    # print("Generation found on: ", best_generation)
+# Create offspring for a chunk of parent index pairs inside a worker process
+def offspring_chunk(pairs):
+    parents = worker_state['parents']
+    offsprings = []
+    for first, second in pairs:
+        offsprings.extend(generate_offspring([parents[first], parents[second]], worker_state['occurrences']))
+    return np.array(offsprings), [fitness(offspring) for offspring in offsprings]
 
-    while run_time > (time.time() - start):
-        # Elitism and culling
-        next_pop = elitism(population, ELITISM)
-        remaining_bins = culling(population, CULLING)
 
-        # Get parents (selection) and add offspring to next generation (crossover)
-        while len(next_pop) < SAMPLE_SIZE:
-            parents = selection(remaining_bins, fitness, False)
-            next_pop.extend(generate_offspring(parents, occur_map))
+# Calculate the fitness of a chunk of bins inside a worker process
+def fitness_chunk(population):
+    return [fitness(bins) for bins in population]
+
+
+# Start a worker pool sharing the surviving parents through shared memory, with room for a
+# population of size states
+def allocation_pool(workers, occurrences, shape=(BINS, 10), size=SAMPLE_SIZE):
+    parents = SharedArray((size,) + tuple(shape))
+    return WorkerPool(workers, {'occurrences': occurrences}, {'parents': parents})
+
+
+# Generate offspring for all parent pairs across the worker pool
+def parallel_offspring(pool, parents, pairs, cache):
+    pool.shared['parents'].array[:len(parents)] = parents
+    offsprings = []
+    for chunk_offsprings, chunk_fit_vals in pool.map_chunks(offspring_chunk, pairs):
+        for offspring, fit_val in zip(chunk_offsprings, chunk_fit_vals):
+            cache.put(offspring, fit_val)
+            offsprings.append(offspring)
+    return offsprings
+
+
+# Evaluate every uncached set of bins across the worker pool
+def parallel_fitness(pool, population, cache):
+    missing = [bins for bins in population if bins not in cache]
+    for chunk, chunk_fit_vals in zip(split_chunks(missing, pool.workers), pool.map_chunks(fitness_chunk, missing)):
+        for bins, fit_val in zip(chunk, chunk_fit_vals):
+            cache.put(bins, fit_val)
+
+
+# Snapshot of an allocation run for checkpointing, copied so it can be written in the background
+def allocation_snapshot(engine, population, best_population, best_fitness, generation, best_generation):
+    snapshot = rng_snapshot()
+    snapshot.update({
+        'engine': engine,
+        'population': np.array(population),
+        'best': np.array(best_population),
+        'best_fitness': best_fitness,
+        'generation': generation,
+        'best_generation': best_generation
+    })
+    return snapshot
+
+
+# Check a checkpoint belongs to the engine resuming it and restore its random state
+def resume_snapshot(snapshot, engine):
+    if str(snapshot['engine']) != engine:
+        raise ValueError("checkpoint was written by the " + str(snapshot['engine']) + " engine, not " + engine)
+    restore_rng(snapshot)
+    return snapshot['population'], snapshot['best'], snapshot['best_fitness'], \
+        int(snapshot['generation']), int(snapshot['best_generation'])
+
+
+# Number allocation with the population kept as a list of bin arrays, every fitness lookup goes
+# through the cache and offspring and fitness are spread over the worker pool when there is one
+class AllocationProblem(Problem):
+    engine = 'classic'
+    sample_size = SAMPLE_SIZE
+    elite_num = ELITISM
+    culling_num = CULLING
+
+    def __init__(self, number_list, sample_size=SAMPLE_SIZE, bins=BINS, stats=None, cache=None, pool=None):
+        self.number_list = number_list
+        self.cache = allocation_cache() if cache is None else cache
+        self.pool = pool
+        self.bins = bins
+        self.occurrences = gen_occurrence_arrays(number_list)
+        self.stats = NullStats() if stats is None else stats
+        self.resize(sample_size)
+
+    # Grow the cache along with the population so it keeps CACHE_GENERATIONS generations
+    def resize(self, sample_size, elite_fraction=None, culling_fraction=None):
+        super().resize(sample_size, elite_fraction, culling_fraction)
+        self.cache.grow(CACHE_GENERATIONS * sample_size)
+
+    def init_population(self, count):
+        return initialize_population(self.number_list, self.bins, count)
+
+    def fitness_batch(self, population):
+        if self.pool is not None:
+            parallel_fitness(self.pool, population, self.cache)
+        return [self.cache(bins) for bins in population]
+
+    def crossover_batch(self, population, pairs, out=None):
+        if self.pool is not None:
+            return parallel_offspring(self.pool, population, pairs, self.cache)
+        offsprings = []
+        for first, second in pairs:
+            offsprings.extend(generate_offspring([population[first], population[second]], self.occurrences,
+                                                 self.stats))
+        return offsprings
+
+    def mutate_batch(self, population, mask, chance=MUTATION):
+        mutation(population, mask, chance)
+
+    def key(self, bins):
+        return bins_key(bins)
+
+    def snapshot(self, population, best, best_fitness, generation, best_generation):
+        return allocation_snapshot(self.engine, population, best, best_fitness, generation, best_generation)
+
+    def restore(self, snapshot):
+        population, best, best_fitness, generation, best_generation = resume_snapshot(snapshot, self.engine)
+        self.resize(len(population))
+        return list(population), best, best_fitness, generation, best_generation
+
+
+# Generate a population of shuffled bins as one (N, bins, numbers per bin) array
+def initialize_population_array(values, size=SAMPLE_SIZE, bins=BINS):
+    order = np.argsort(np.random.random((size, len(values))), axis=1)
+    return values[order].reshape((size,) + bin_shape(len(values), bins))
+
+
+# Calculate the fitness score of every set of bins in a population array
+def fitness_batch(population):
+    bin_one = np.prod(population[:, 0], axis=1)
+    bin_two = np.sum(population[:, 1], axis=1)
+    bin_three = np.ptp(population[:, 2], axis=1)
+    # Any score that is not above zero, NaN included, is zero as in fitness
+    score = bin_one + bin_two + bin_three
+    return np.where(score > 0, score, 0)
+
+
+# Crossover bins one and three between each pair of parents, writing the children into out if given
+def crossover_batch(population, pairs, out=None):
+    first, second = pairs[:, 0], pairs[:, 1]
+    offsprings = np.take(population, np.concatenate((first, second)), axis=0, out=out, mode='clip')
+    donors = np.concatenate((second, first))
+    offsprings[:, 0] = population[donors, 0]
+    offsprings[:, 2] = population[donors, 2]
+    return offsprings
+
+
+# Resolve illegal children in place so each holds exactly the input numbers,
+# given as sorted distinct values and their counts, returns how many values were replaced
+def repair_batch(offsprings, unique_vals, needed_counts):
+    count = len(offsprings)
+    flat = offsprings.reshape((count, -1))
+    unique_num = len(unique_vals)
+
+    # Give every (offspring, value) pair its own integer key
+    keys = np.searchsorted(unique_vals, flat) + np.arange(count)[:, None] * unique_num
+    keys = keys.ravel()
+    offspring_counts = np.bincount(keys, minlength=count * unique_num)
+
+    # Rank each occurrence within its key in random order, any rank past the
+    # needed count is a value occurring too many times
+    order = np.argsort(keys + np.random.random(len(keys)))
+    sorted_keys = keys[order]
+    ranks = np.empty(len(keys), dtype=np.intp)
+    ranks[order] = np.arange(len(keys)) - np.searchsorted(sorted_keys, sorted_keys)
+    too_many = np.flatnonzero(ranks >= needed_counts[keys % unique_num])
+
+    # Values occurring too few times, shuffled within each offspring
+    shortfall = np.tile(needed_counts, count) - offspring_counts
+    too_few = np.repeat(np.arange(count * unique_num), np.maximum(shortfall, 0))
+    too_few = too_few[np.argsort(too_few // unique_num + np.random.random(len(too_few)))]
+
+    # Both lists are grouped by offspring, so replace them pairwise
+    np.put(offsprings, too_many, unique_vals[too_few % unique_num])
+    return len(too_many)
+
+
+# Swap two values between different bins for a random subset of the states whose mask entry is set
+def mutation_batch(population, mask, chance=MUTATION):
+    count, rows, cols = population.shape
+    chosen = np.flatnonzero((np.random.random(count) < chance) & mask)
+
+    row_1 = np.random.randint(rows, size=len(chosen))
+    row_2 = (row_1 + np.random.randint(1, rows, size=len(chosen))) % rows
+    col_1 = np.random.randint(cols, size=len(chosen))
+    col_2 = np.random.randint(cols, size=len(chosen))
+
+    temp_vals = population[chosen, row_1, col_1]
+    population[chosen, row_1, col_1] = population[chosen, row_2, col_2]
+    population[chosen, row_2, col_2] = temp_vals
+    return population
+
 
-        # Apply chance mutations for each tower
-        next_pop.sort(key=fitness)
-        elites = elitism(next_pop, ELITISM)
-        next_pop = mutation(next_pop, elites)
+# Number allocation with the population kept in one (N, bins, numbers per bin) array, whole
+# populations are evaluated at once so no cache is used
+class VectorizedAllocationProblem(ArrayProblem):
+    engine = 'vectorized'
+    sample_size = SAMPLE_SIZE
+    elite_num = ELITISM
+    culling_num = CULLING
 
-        generation += 1
+    def __init__(self, number_list, sample_size=SAMPLE_SIZE, bins=BINS, stats=None, cache=None):
+        self.values = np.array(number_list, dtype=float)
+        self.bins = bins
+        self.shape = bin_shape(len(self.values), bins)
+        self.occurrences = gen_occurrence_arrays(self.values)
+        self.stats = NullStats() if stats is None else stats
+        self.resize(sample_size)
 
-        # Get best tower in next generation
-        next_pop.sort(key=fitness)
-        curr_best_pop = next_pop[-1]
-        curr_best_fit = fitness(curr_best_pop)
-        if curr_best_fit > best_fitness:
-            best_generation = generation
-            best_fitness = curr_best_fit
-            best_population = copy.copy(curr_best_pop)
+    def init_population(self, count):
+        return initialize_population_array(self.values, count, self.bins)
 
-        # Reset population and increment generations
-        population = copy.copy(next_pop)
+    def fitness_batch(self, population):
+        return fitness_batch(population)
 
-        # print("Best fitness: ", best_fitness)
-        # print("Generations ran through: ", generation)
-        # print("Generation found on: ", best_generation)
+    def crossover_batch(self, population, pairs, out=None):
+        offsprings = crossover_batch(population, pairs, out)
+        self.stats.lap('crossover')
+        self.stats.count('repair_swaps', repair_batch(offsprings, *self.occurrences))
+        self.stats.lap('repair')
+        return offsprings
 
-    return best_population, best_fitness, generation, best_generation
+    def mutate_batch(self, population, mask, chance=MUTATION):
+        mutation_batch(population, mask, chance)
+
+    def snapshot(self, population, best, best_fitness, generation, best_generation):
+        return allocation_snapshot(self.engine, population, best, best_fitness, generation, best_generation)
+
+    def restore(self, snapshot):
+        population, best, best_fitness, generation, best_generation = resume_snapshot(snapshot, self.engine)
+        self.resize(len(population))
+        return population, best, best_fitness, generation, best_generation
+
+
+# Generate a population of permutations of indexes into the input numbers
+def initialize_permutations(length, size=SAMPLE_SIZE):
+    return np.argsort(np.random.random((size, length)), axis=1)
+
+
+# Turn permutations of indexes into (N, bins, numbers per bin) arrays
+def decode_permutations(population, values, bins=BINS):
+    return values[population].reshape((len(population),) + bin_shape(len(values), bins))
+
+
+# Order crossover between each pair of parents, children are always legal and written into out if given
+def order_crossover_batch(population, pairs, out=None):
+    first = np.take(population, np.concatenate((pairs[:, 0], pairs[:, 1])), axis=0, out=out, mode='clip')
+    second = population[np.concatenate((pairs[:, 1], pairs[:, 0]))]
+    count, length = first.shape
+    rows = np.arange(count)[:, None]
+    positions = np.arange(length)
+
+    # Each child keeps a random segment of its first parent in place
+    cuts = np.sort(np.random.randint(length + 1, size=(count, 2)), axis=1)
+    in_segment = (positions >= cuts[:, :1]) & (positions < cuts[:, 1:])
+    segment_genes = np.zeros((count, length), dtype=bool)
+    segment_genes[rows, first] = in_segment
+
+    # The rest is filled with the remaining genes in the order of the second parent
+    fill = np.take_along_axis(second, np.argsort(segment_genes[rows, second], axis=1, kind='stable'), axis=1)
+    free = np.argsort(in_segment, axis=1, kind='stable')
+    valid = positions < length - (cuts[:, 1:] - cuts[:, :1])
+
+    # Each child starts as its first parent, which is no longer needed
+    first[np.broadcast_to(rows, (count, length))[valid], free[valid]] = fill[valid]
+    return first
+
+
+# Number allocation with a genome of indexes into the input, kept in one (N, length) array
+class PermutationAllocationProblem(VectorizedAllocationProblem):
+    engine = 'permutation'
+
+    def init_population(self, count):
+        return initialize_permutations(len(self.values), count)
+
+    def decode(self, population):
+        return decode_permutations(population, self.values, self.bins)
+
+    def fitness_batch(self, population):
+        return fitness_batch(self.decode(population))
+
+    def crossover_batch(self, population, pairs, out=None):
+        return order_crossover_batch(population, pairs, out)
+
+    def mutate_batch(self, population, mask, chance=MUTATION):
+        mutation_batch(population.reshape((len(population),) + self.shape), mask, chance)
+
+    def solution(self, state):
+        return self.values[state].reshape(self.shape)
+
+
+# Number allocation problems by engine, each taking (number_list, sample_size, bins, stats, cache)
+ENGINES = {'classic': AllocationProblem,
+           'vectorized': VectorizedAllocationProblem,
+           'permutation': PermutationAllocationProblem}
+
+
+# Run the genetic algorithm with the given engine, returning the best bins, their fitness, the
+# generations run and the generation they were found on. Only the classic engine spreads its
+# work over worker processes and looks up every fitness through the cache
+def find_best_allocation(number_list, run_time, cache=None, workers=1, reporter=None, max_generations=None,
+                         stats=None, checkpoint=None, resume=None, stall=None, on_stall='stop', on_improve=None,
+                         bins=BINS, duplicates='drop', scheduler=None, selection='roulette', engine='classic',
+                         sample_size=SAMPLE_SIZE):
+    deadline = time.time() + run_time
+    if cache is None:
+        cache = allocation_cache()
+    if stats is None:
+        stats = NullStats()
+    cache_misses = cache.misses
+    problem = ENGINES[engine](number_list, sample_size, bins, stats, cache)
+
+    # Spread offspring generation and fitness over worker processes if asked
+    pool = None
+    if workers > 1 and engine == 'classic':
+        # The parents shared with the workers have room for the population, or the one resumed
+        size = max(problem.sample_size, len(resume['population']) if resume is not None else 0)
+        pool = problem.pool = allocation_pool(workers, problem.occurrences, bin_shape(len(number_list), bins), size)
+        problem.max_sample_size = size
+
+    try:
+        # Generate population of bins, or pick up where a checkpoint left off
+        ga = GeneticAlgorithm(problem, stats, duplicates, selection)
+        ga.start(resume, deadline)
+        result = ga.run(deadline, reporter, max_generations, checkpoint, stall, on_stall, on_improve, scheduler)
+    finally:
+        if pool is not None:
+            pool.close()
+
+    if engine == 'classic':
+        stats.count('fitness_evals', cache.misses - cache_misses)
+    return result
 
 if __name__ == "__main__":
     print(fitness(list([
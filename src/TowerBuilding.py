@@ -1,16 +1,28 @@
+import bisect
 import random
-import copy
 import time
-import math
+
+import numpy as np
+
+from ga_utils import FitnessCache, GeneticAlgorithm, NullStats, Problem
+from parallel import WorkerPool, split_chunks, worker_state
+from reporting import TextReporter
+from checkpoint import restore_rng, rng_snapshot
 
 # Constants
 SAMPLE_SIZE = 800
 ELITISM = 160
 CULLING = 240
 FITNESS = 20
+MUTATION = 0.2
+CACHE_GENERATIONS = 4
+CACHE_SIZE = CACHE_GENERATIONS * SAMPLE_SIZE
+CHOICE_ATTEMPTS = 8
 
 # Class for piece objects
 class Piece:
+    __slots__ = ('type', 'width', 'strength', 'cost', 'id')
+
     def __init__(self, type, width, strength, cost, id):
         self.type = type
         self.width = width
@@ -18,24 +30,112 @@ class Piece:
         self.cost = cost
         self.id = id
 
-# Class for tower objects
+# Class for tower objects, mask has bit n set when piece id n is on the tower
+# Once fitness has counted a tower the remaining fields are kept up to date so
+# later changes never rescan it: walls counts wall pieces, narrowings counts
+# pieces wider than the piece below, and reach[i] is the smallest
+# strength + index over the bottom i + 1 pieces (None until counted)
 class Tower:
+    __slots__ = ('pieces', 'id', 'mask', 'cost', 'walls', 'narrowings', 'reach')
+
     def __init__(self, id):
         self.pieces = []
         self.id = id
+        self.mask = 0
+        self.reach = None
+
+    def setPieces(self, pieces):
+        self.pieces = list(pieces)
+        self.mask = 0
+        self.reach = None
+        for piece in self.pieces:
+            self.mask |= 1 << piece.id
+
+    def addPiece(self, piece):
+        if self.reach is not None:
+            self.insertPiece(len(self.pieces), piece)
+            return
+        self.pieces.append(piece)
+        self.mask |= 1 << piece.id
+
+    def insertPiece(self, index, piece):
+        if self.reach is not None:
+            self.narrowings += self.neighbourNarrowings(index, piece) - self.neighbourNarrowings(index)
+            self.countPiece(piece, 1)
+            self.reach.append(0)
+        self.pieces.insert(index, piece)
+        self.mask |= 1 << piece.id
+        self.updateReach(index)
+
+    def popPiece(self, index):
+        piece = self.pieces.pop(index)
+        self.mask &= ~(1 << piece.id)
+        if self.reach is not None:
+            self.narrowings += self.neighbourNarrowings(index) - self.neighbourNarrowings(index, piece)
+            self.countPiece(piece, -1)
+            self.reach.pop()
+        self.updateReach(index)
+        return piece
+
+    # Count every piece of the tower from scratch
+    def countPieces(self):
+        self.cost = 0
+        self.walls = 0
+        self.narrowings = 0
+        self.reach = []
+        for piece in self.pieces:
+            self.countPiece(piece, 1)
+            self.reach.append(0)
+        self.narrowings = sum(below.width < above.width for below, above in zip(self.pieces, self.pieces[1:]))
+        self.updateReach(0)
 
-# File parser for getting pieces
+    # Add or remove a piece from the cost and wall count
+    def countPiece(self, piece, sign):
+        self.cost += sign * piece.cost
+        self.walls += sign * (piece.type == "Wall")
+
+    # Narrowings between the pieces either side of index, with piece between them if given
+    def neighbourNarrowings(self, index, piece=None):
+        below = self.pieces[index - 1] if index > 0 else None
+        above = self.pieces[index] if index < len(self.pieces) else None
+        if piece is None:
+            return int(below is not None and above is not None and below.width < above.width)
+        count = 0
+        if below is not None:
+            count += below.width < piece.width
+        if above is not None:
+            count += piece.width < above.width
+        return count
+
+    # Recompute reach from index upwards after pieces at or above it moved
+    def updateReach(self, index):
+        if self.reach is None:
+            return
+        lowest = self.reach[index - 1] if index > 0 else None
+        for position in range(index, len(self.pieces)):
+            key = self.pieces[position].strength + position
+            if lowest is None or key < lowest:
+                lowest = key
+            self.reach[position] = lowest
+
+# Read one piece per line as "type width strength cost", reporting bad lines by number
 def towerBuildingParser(filepath):
-    piecesList = []
     with open(filepath, 'r') as f:
-        lines = f.readlines()
-        f.close()
-    count = 0
-    for line in lines:
-        str = line.replace('\n', '').split()
-        piece = Piece(str[0], int(str[1]), int(str[2]), int(str[3]), count)
-        piecesList.append(piece)
-        count = count + 1
+        return parsePieces(f.read(), filepath)
+
+# Parse pieces from the text of an input, filepath names the input when reporting a bad line
+def parsePieces(text, filepath='<input>'):
+    piecesList = []
+    for lineNum, line in enumerate(text.split('\n'), 1):
+        str = line.split()
+        if str:
+            try:
+                if len(str) != 4:
+                    raise ValueError
+                piecesList.append(Piece(str[0], int(str[1]), int(str[2]), int(str[3]), len(piecesList)))
+            except ValueError:
+                raise ValueError("%s:%d: expected 'type width strength cost', got %r"
+                                 % (filepath, lineNum, line)) from None
     return piecesList
 
 # Helper function for printing given pieces
@@ -44,16 +144,12 @@ def printPieces(piecesList):
         print(piece.type + " " + str(piece.width) + " " + str(piece.strength) + " " + str(piece.cost) + " " + str(piece.id))
 
 # Generate random population states with given pieces
-def generateStates(pieces):
+def generateStates(pieces, count=SAMPLE_SIZE):
     towers = []
-    for towerNum in range(SAMPLE_SIZE):
+    for towerNum in range(count):
         tower = Tower(random.random())
         towerSize = random.randrange(1, len(pieces) + 1)
-        piecesToPick = list(range((len(pieces))))
-        for pieceNum in range(towerSize):
-            pieceRand = random.choice(piecesToPick)
-            tower.pieces.append(pieces[pieceRand])
-            piecesToPick.remove(pieceRand)
+        tower.setPieces(random.sample(pieces, towerSize))
         towers.append(tower)
     return towers
 
@@ -64,19 +160,46 @@ def printStates(towers):
         print()
 
 # Print specified tower state
-def printState(tower):
+def printState(tower, fitFunc=None):
+    if fitFunc is None:
+        fitFunc = fitness
     print("Tower ID: " + str(tower.id))
     for piece in tower.pieces:
         print(piece.type + " " + str(piece.width) + " " + str(piece.strength) + " " + str(piece.cost))
-    print("Score: " + str(fitness(tower) - FITNESS))
+    print("Score: " + str(fitFunc(tower) - FITNESS))
+
+# Check a tower against every rule, read from the running totals kept by the tower
+def validTower(tower):
+    pieces = tower.pieces
+    height = len(pieces)
+    # Bottom piece must be a door and top piece must be a lookout
+    if height < 2 or pieces[0].type != "Door" or pieces[-1].type != "Lookout":
+        return False
+    if tower.reach is None:
+        tower.countPieces()
+    # Pieces between top and bottom must be wall segments
+    if tower.walls != height - 2:
+        return False
+    # Pieces can, at most, be as wide as the piece below it
+    if tower.narrowings > 0:
+        return False
+    # Pieces can support its strength value in pieces placed above it
+    return tower.reach[-1] >= height - 1
 
 # Tower fitness function
 def fitness(tower):
+    if not validTower(tower):
+        return FITNESS
+    # Valid tower fitness calculation
+    return 10 + pow(len(tower.pieces), 2) - tower.cost + FITNESS
+
+# Reference fitness function re-checking every piece of the tower
+def scanFitness(tower):
     pieces = tower.pieces
     height = len(pieces)
     totalCost = 0
     # Bottom piece must be a door and top piece must be a lookout
-    if pieces[0].type != "Door" or pieces[-1].type != "Lookout":
+    if height == 0 or pieces[0].type != "Door" or pieces[-1].type != "Lookout":
         return FITNESS
     for index in range(height):
         # Pieces between top and bottom must be wall segments
@@ -92,59 +215,17 @@ def fitness(tower):
     # Valid tower fitness calculation
     return 10 + pow(height, 2) - totalCost + FITNESS
 
-# Get summed fitness for given towers
-def getSummedFitness(towers):
-    total = 0
-    for tower in towers:
-        total = total + fitness(tower)
-    return total
+# Cache key for a tower, the ids of its pieces from bottom to top
+def towerKey(tower):
+    return tuple(piece.id for piece in tower.pieces)
 
-# Get chance of parent selection for given towers
-def getSelectionChances(towers, totalFitness):
-    selChances = []
-    for tower in towers:
-        selChances.append((fitness(tower)) / (totalFitness))
-    return selChances
-
-# Get elite states to save through elitism
-def elitism(towers):
-    elites = []
-    for index in range(ELITISM):
-        elites.append(towers[-index - 1])
-    return elites
-
-# Remove weakest states through culling
-def culling(towers):
-    notCulled = []
-    for index in range(len(towers) - CULLING):
-        notCulled.append(towers[-index - 1])
-    return notCulled
-
-# Select parents with weighting towards higher fitness
-def selection(towers):
-    parents = []
-    totalFitness = getSummedFitness(towers)
-    selChances = getSelectionChances(towers, totalFitness)
-    while len(parents) < 2:
-        randomNum = random.random()
-        cumulativeProb = 0
-        for index in range(len(selChances)):
-            cumulativeProb = cumulativeProb + selChances[index]
-            if randomNum < cumulativeProb and len(parents) == 1 and parents[0].id != towers[index].id:
-                parents.append(towers[index])
-                break
-            elif randomNum < cumulativeProb and len(parents) == 0:
-                parents.append(towers[index])
-                break
-    return parents
+# Create a fitness cache for towers
+def towerCache(maxSize=CACHE_SIZE):
+    return FitnessCache(fitness, towerKey, maxSize)
 
 # Check if given piece is already on given tower
 def validAddPiece(tower, newPiece):
-    retVal = 1
-    for piece in tower.pieces:
-        if piece.id == newPiece.id:
-            retVal = 0
-    return retVal
+    return 0 if tower.mask >> newPiece.id & 1 else 1
 
 # apply crossover to top, middle, and bottom components
 def crossover(parents):
@@ -153,103 +234,447 @@ def crossover(parents):
     child1 = Tower(random.random())
     child2 = Tower(random.random())
     # Apply crossover for top components
-    child1.pieces.append(parents[0].pieces[0])
-    child2.pieces.append(parents[1].pieces[0])
+    child1.addPiece(parents[0].pieces[0])
+    child2.addPiece(parents[1].pieces[0])
     # Apply crossover for middle components
     flag = 1
     for index in range(1, len(parents[0].pieces) - 1):
         if flag == 1 and validAddPiece(child1, parents[0].pieces[index]) == 1:
-            child1.pieces.append(parents[0].pieces[index])
+            child1.addPiece(parents[0].pieces[index])
             flag = 2
         elif validAddPiece(child2, parents[0].pieces[index]) == 1:
-            child2.pieces.append(parents[0].pieces[index])
+            child2.addPiece(parents[0].pieces[index])
             flag = 1
     for index in range(1, len(parents[1].pieces) - 1):
         if flag == 1 and validAddPiece(child1, parents[1].pieces[index]) == 1:
-            child1.pieces.append(parents[1].pieces[index])
+            child1.addPiece(parents[1].pieces[index])
             flag = 2
         elif validAddPiece(child2, parents[1].pieces[index]) == 1:
-            child2.pieces.append(parents[1].pieces[index])
+            child2.addPiece(parents[1].pieces[index])
             flag = 1
     # Apply crossover for bottom components
     if validAddPiece(child1, parents[1].pieces[-1]) == 1:
-        child1.pieces.append(parents[1].pieces[-1])
+        child1.addPiece(parents[1].pieces[-1])
     elif validAddPiece(child1, parents[0].pieces[-1]) == 1:
-        child1.pieces.append(parents[0].pieces[-1])
+        child1.addPiece(parents[0].pieces[-1])
     if validAddPiece(child2, parents[0].pieces[-1]) == 1:
-        child2.pieces.append(parents[0].pieces[-1])
+        child2.addPiece(parents[0].pieces[-1])
     elif validAddPiece(child2, parents[1].pieces[-1]) == 1:
-        child2.pieces.append(parents[1].pieces[-1])
+        child2.addPiece(parents[1].pieces[-1])
     # Append children to children list
     children.append(child1)
     children.append(child2)
     return children
 
-# randomly swap a piece between two towers
-def mutation(towers, elites):
-    for tower in towers:
+# randomly swap a piece between two towers, both must have their mask entry set
+def mutation(towers, mask, chance=MUTATION):
+    for index, tower in enumerate(towers):
         mutRand = random.random()
-        if mutRand < 0.2:
+        if mutRand < chance:
             swapTower = random.randrange(len(towers))
-            for elite in elites:
-                if tower.id == elite.id or towers[swapTower].id == elite.id:
-                    return towers
+            if not mask[index] or not mask[swapTower]:
+                continue
+            # Never take the only piece of a tower
+            if len(towers[swapTower].pieces) < 2:
+                continue
             insertPos = random.randrange(len(tower.pieces))
             pieceNum = random.randrange(len(towers[swapTower].pieces))
             piece = towers[swapTower].pieces[pieceNum]
             if validAddPiece(tower, piece) == 1:
-                towers[swapTower].pieces.pop(pieceNum)
-                tower.pieces.insert(insertPos, piece)
+                towers[swapTower].popPiece(pieceNum)
+                tower.insertPiece(insertPos, piece)
     return towers
 
+# Copy of a tower that later changes to the original leave alone
+def copyTower(tower):
+    copied = Tower(tower.id)
+    copied.setPieces(tower.pieces)
+    return copied
+
+# Pieces of each type sorted by width, used to find the pieces that fit at a position of a tower
+# without trying the whole piece set. Doors only count when a lookout fits on them and they can
+# hold it, since no valid tower can start from any other door
+class PieceIndex:
+    def __init__(self, pieces):
+        self.byType = {}
+        for pieceType in ("Door", "Wall", "Lookout"):
+            typed = sorted((piece for piece in pieces if piece.type == pieceType), key=lambda piece: piece.width)
+            self.byType[pieceType] = (typed, [piece.width for piece in typed])
+        # Lookouts with negative strength can never top a tower
+        lookoutWidths = [piece.width for piece in self.byType["Lookout"][0] if piece.strength >= 0]
+        self.narrowestLookout = lookoutWidths[0] if lookoutWidths else None
+        self.doors = [door for door in self.byType["Door"][0] if self.viableDoor(door)]
+
+    # Check a piece can be the bottom of a valid tower
+    def viableDoor(self, piece):
+        return (piece.type == "Door" and piece.strength >= 1 and self.narrowestLookout is not None and
+                piece.width >= self.narrowestLookout)
+
+    # Random piece of a type with width between low and high and at least the given strength that is
+    # not on the mask, or None if there is none. A few random picks are tried before scanning the range
+    def choose(self, pieceType, mask, low=0, high=None, strength=0):
+        typed, widths = self.byType[pieceType]
+        start = bisect.bisect_left(widths, low)
+        end = len(typed) if high is None else bisect.bisect_right(widths, high)
+        if start >= end:
+            return None
+        for attempt in range(CHOICE_ATTEMPTS):
+            piece = typed[random.randrange(start, end)]
+            if not mask >> piece.id & 1 and piece.strength >= strength:
+                return piece
+        fitting = [piece for piece in typed[start:end] if not mask >> piece.id & 1 and piece.strength >= strength]
+        return random.choice(fitting) if fitting else None
+
+# Stack walls on a door in the given order, skipping those that would break a rule, and finish with
+# the lookout if it fits or else a random lookout that does. A chain of length L topped by a lookout
+# is valid while the smallest strength + index in it is at least L
+def stackTower(index, door, walls, lookout=None):
+    chain = [door]
+    mask = 1 << door.id
+    reach = door.strength
+    for wall in walls:
+        length = len(chain)
+        if reach < length + 1:
+            break
+        if (wall.strength < 1 or mask >> wall.id & 1 or wall.width > chain[-1].width or
+                wall.width < index.narrowestLookout):
+            continue
+        chain.append(wall)
+        mask |= 1 << wall.id
+        reach = min(reach, wall.strength + length)
+    if lookout is None or lookout.strength < 0 or lookout.width > chain[-1].width:
+        lookout = index.choose("Lookout", mask, high=chain[-1].width)
+    tower = Tower(random.random())
+    # Viable doors and the walls kept always leave a lookout that fits, the tower is left without
+    # one rather than failing if not
+    tower.setPieces(chain + [lookout] if lookout is not None else chain)
+    return tower
+
+# Generate random towers that all pass every rule, each a random viable door with walls drawn from
+# those that fit on the piece below until a random height is reached or nothing fits
+def generateValidStates(index, count=SAMPLE_SIZE):
+    wallCount = len(index.byType["Wall"][0])
+    towers = []
+    for towerNum in range(count):
+        door = random.choice(index.doors)
+        walls = []
+        mask = 1 << door.id
+        top = door
+        for wallNum in range(random.randrange(wallCount + 1)):
+            wall = index.choose("Wall", mask, index.narrowestLookout, top.width, 1)
+            if wall is None:
+                break
+            walls.append(wall)
+            mask |= 1 << wall.id
+            top = wall
+        towers.append(stackTower(index, door, walls))
+    return towers
+
+# Crossover keeping every child valid: each child takes the door of one parent, the walls both
+# parents share and about half of the rest, widest first, and the lookout of the other parent
+def validCrossover(parents, index):
+    children = []
+    for first, second in (parents, parents[::-1]):
+        door = first.pieces[0] if index.viableDoor(first.pieces[0]) else random.choice(index.doors)
+        shared = first.mask & second.mask
+        walls = {}
+        for tower in parents:
+            for piece in tower.pieces:
+                if piece.type == "Wall" and (shared >> piece.id & 1 or random.random() < 0.5):
+                    walls[piece.id] = piece
+        walls = sorted(walls.values(), key=lambda piece: (-piece.width, -piece.strength))
+        lookout = second.pieces[-1] if second.pieces[-1].type == "Lookout" else None
+        children.append(stackTower(index, door, walls, lookout))
+    return children
+
+# Change a tower by one edit that keeps it valid, inserting, removing or replacing a wall or
+# replacing the door or lookout with an unused piece that fits there. Invalid towers are left alone
+def mutateValid(tower, index):
+    if not validTower(tower):
+        return
+    pieces = tower.pieces
+    height = len(pieces)
+    edit = random.randrange(3)
+    if edit == 0:
+        position = random.randrange(1, height)
+        wall = index.choose("Wall", tower.mask, pieces[position].width, pieces[position - 1].width, 1)
+        if wall is not None:
+            tower.insertPiece(position, wall)
+            if not validTower(tower):
+                tower.popPiece(position)
+    elif edit == 1 and height > 2:
+        # Taking out a wall never breaks a rule
+        tower.popPiece(random.randrange(1, height - 1))
+    else:
+        position = random.randrange(height)
+        piece = pieces[position]
+        low = pieces[position + 1].width if position + 1 < height else 0
+        high = pieces[position - 1].width if position > 0 else None
+        replacement = index.choose(piece.type, tower.mask, low, high)
+        if replacement is not None:
+            tower.popPiece(position)
+            tower.insertPiece(position, replacement)
+            if not validTower(tower):
+                tower.popPiece(position)
+                tower.insertPiece(position, piece)
+
+# Mutate each masked tower with the given chance, keeping valid towers valid
+def validMutation(towers, mask, index, chance=MUTATION):
+    for position, tower in enumerate(towers):
+        if mask[position] and random.random() < chance:
+            mutateValid(tower, index)
+    return towers
+
+# Best possible tower, or None if no valid tower exists, by dynamic programming over the doors and
+# walls sorted widest first. Doors come before walls of the same width and stronger pieces before
+# weaker ones, so some best tower always stacks its pieces in this order. For each height the
+# cheapest chain of a door and walls ending on each piece is built one position at a time, then
+# topped with the cheapest lookout that fits. Heights that cannot beat the best found even with
+# the cheapest pieces are skipped. Takes about height^2 / 2 vector passes over the pieces, so it
+# suits small to medium piece sets
+def exactTower(pieces):
+    chainPieces = sorted((piece for piece in pieces if piece.type in ("Door", "Wall")),
+                         key=lambda piece: (-piece.width, piece.type != "Door", -piece.strength))
+    lookouts = sorted((piece for piece in pieces if piece.type == "Lookout" and piece.strength >= 0),
+                      key=lambda piece: piece.width)
+    isDoor = np.array([piece.type == "Door" for piece in chainPieces], dtype=bool)
+    if not lookouts or not isDoor.any():
+        return None
+    isWall = ~isDoor
+    widths = np.array([piece.width for piece in chainPieces])
+    strengths = np.array([piece.strength for piece in chainPieces])
+    costs = np.array([piece.cost for piece in chainPieces], dtype=float)
+    positions = np.arange(len(chainPieces))
+    # Cheapest lookout no wider than each door or wall
+    lookoutCosts = np.array([piece.cost for piece in lookouts], dtype=float)
+    cheapest = np.minimum.accumulate(lookoutCosts)
+    cheapestAt = np.maximum.accumulate(np.where(lookoutCosts == cheapest, np.arange(len(lookouts)), 0))
+    fits = np.searchsorted([piece.width for piece in lookouts], widths, side='right') - 1
+    topCosts = np.where(fits >= 0, cheapest[np.maximum(fits, 0)], np.inf)
+    # Lower bound on the cost of each height for pruning
+    wallCosts = np.concatenate(([0], np.cumsum(np.sort(costs[isWall]))))
+    leastCost = costs[isDoor].min() + lookoutCosts.min()
+    maxHeight = min(int(strengths[isDoor].max()) + 1, int(isWall.sum()) + 2)
+    best = None
+    bestScore = None
+    for height in range(2, maxHeight + 1):
+        score = 10 + pow(height, 2)
+        if bestScore is not None and score - leastCost - wallCosts[height - 2] <= bestScore:
+            continue
+        chainCosts = np.where(isDoor & (strengths >= height - 1), costs, np.inf)
+        below = []
+        for position in range(1, height - 1):
+            # A wall can only sit on a piece before it in the order, which is at least as wide
+            runningCosts = np.minimum.accumulate(chainCosts)
+            runningAt = np.maximum.accumulate(np.where(chainCosts == runningCosts, positions, 0))
+            holds = isWall & (strengths >= height - 1 - position)
+            chainCosts = np.full(len(chainPieces), np.inf)
+            chainCosts[1:] = np.where(holds[1:], costs[1:] + runningCosts[:-1], np.inf)
+            below.append(np.concatenate(([0], runningAt[:-1])))
+        totals = chainCosts + topCosts
+        top = int(np.argmin(totals))
+        if not np.isfinite(totals[top]) or (bestScore is not None and score - totals[top] <= bestScore):
+            continue
+        bestScore = score - totals[top]
+        chain = [top]
+        for pointers in reversed(below):
+            chain.append(int(pointers[chain[-1]]))
+        best = [chainPieces[position] for position in reversed(chain)] + [lookouts[int(cheapestAt[fits[top]])]]
+    if best is None:
+        return None
+    tower = Tower(random.random())
+    tower.setPieces(best)
+    return tower
+
 # Print final statistics function
-def printStatistics(bestTower, generations, foundGen):
+def printStatistics(bestTower, generations, foundGen, fitFunc=None):
     print("Best Solution:")
-    printState(bestTower)
+    printState(bestTower, fitFunc)
     print("Generations ran through: " + str(generations))
     print("Generation found on: " + str(foundGen))
     print()
 
+# Printer for text reporters showing the full statistics of the best tower
+def statisticsPrinter(fitFunc=None):
+    return lambda bestTower, generations, foundGen: printStatistics(bestTower, generations, foundGen, fitFunc)
+
+# Rebuild a tower from the ids of its pieces
+def towerFromKey(pieces, key):
+    tower = Tower(random.random())
+    tower.setPieces(pieces[pieceId] for pieceId in key)
+    return tower
+
+# Crossover a chunk of parent pairs inside a worker process
+def crossoverChunk(pairs):
+    pieces = worker_state['pieces']
+    index = worker_state['index']
+    children = []
+    for first, second in pairs:
+        parents = [towerFromKey(pieces, first), towerFromKey(pieces, second)]
+        for child in (crossover(parents) if index is None else validCrossover(parents, index)):
+            children.append((towerKey(child), fitness(child)))
+    return children
+
+# Calculate the fitness of a chunk of towers inside a worker process
+def fitnessChunk(keys):
+    pieces = worker_state['pieces']
+    return [fitness(towerFromKey(pieces, key)) for key in keys]
+
+# Start a worker pool holding the pieces and the piece index if crossover keeps towers valid,
+# towers are sent as tuples of piece ids
+def towerPool(workers, pieces, index=None):
+    return WorkerPool(workers, {'pieces': pieces, 'index': index})
+
+# Crossover all parent pairs across the worker pool
+def parallelCrossover(pool, towers, pairs, cache):
+    pieces = pool.state['pieces']
+    keyPairs = [(towerKey(towers[first]), towerKey(towers[second])) for first, second in pairs]
+    children = []
+    for chunk in pool.map_chunks(crossoverChunk, keyPairs):
+        for key, fitVal in chunk:
+            child = towerFromKey(pieces, key)
+            cache.put(child, fitVal)
+            children.append(child)
+    return children
+
+# Evaluate every uncached tower across the worker pool
+def parallelFitness(pool, towers, cache):
+    missing = [towerKey(tower) for tower in towers if tower not in cache]
+    chunks = split_chunks(missing, pool.workers)
+    for chunk, chunkFitVals in zip(chunks, pool.map_chunks(fitnessChunk, missing)):
+        for key, fitVal in zip(chunk, chunkFitVals):
+            cache.put(towerFromKey(pool.state['pieces'], key), fitVal)
+
+# Encode towers as one array of piece ids and the offset where each tower ends
+def encodeTowers(towers):
+    ends = np.cumsum([len(tower.pieces) for tower in towers], dtype=np.int64)
+    ids = np.fromiter((piece.id for tower in towers for piece in tower.pieces), dtype=np.int32,
+                      count=int(ends[-1]) if len(ends) else 0)
+    return ids, ends
+
+# Rebuild towers from the arrays made by encodeTowers
+def decodeTowers(pieces, ids, ends):
+    return [towerFromKey(pieces, tower) for tower in np.split(ids, ends[:-1])]
+
+# Snapshot of a tower building run for checkpointing
+def towerSnapshot(towers, bestTower, generations, foundGen):
+    snapshot = rng_snapshot()
+    ids, ends = encodeTowers(towers)
+    snapshot.update({
+        'engine': 'towers',
+        'tower_ids': ids,
+        'tower_ends': ends,
+        'best': np.array(towerKey(bestTower), dtype=np.int32),
+        'generation': generations,
+        'best_generation': foundGen
+    })
+    return snapshot
+
+# Tower building for the shared generation loop, every fitness lookup goes through the cache
+# and crossover and fitness are spread over the worker pool when there is one. With the 'valid'
+# operators every generated, crossed or mutated tower passes the rules, falling back to the
+# 'random' ones when the pieces cannot make a valid tower at all. Seed towers are copied into
+# the first population and every restart
+class TowerProblem(Problem):
+    sample_size = SAMPLE_SIZE
+    elite_num = ELITISM
+    culling_num = CULLING
+
+    def __init__(self, pieces, cache, pool=None, operators='valid', seeds=()):
+        self.pieces = pieces
+        self.cache = cache
+        self.pool = pool
+        self.index = None
+        if operators == 'valid':
+            index = PieceIndex(pieces)
+            if index.doors:
+                self.index = index
+        self.seeds = list(seeds)
+
+    # Grow the cache along with the population so it keeps CACHE_GENERATIONS generations
+    def resize(self, sample_size, elite_fraction=None, culling_fraction=None):
+        super().resize(sample_size, elite_fraction, culling_fraction)
+        self.cache.grow(CACHE_GENERATIONS * sample_size)
+
+    def init_population(self, count):
+        if self.index is None:
+            return generateStates(self.pieces, count)
+        return generateValidStates(self.index, count)
+
+    def fitness_batch(self, towers):
+        if self.pool is not None:
+            parallelFitness(self.pool, towers, self.cache)
+        return [self.cache(tower) for tower in towers]
+
+    def crossover_batch(self, towers, pairs, out=None):
+        if self.pool is not None:
+            return parallelCrossover(self.pool, towers, pairs, self.cache)
+        children = []
+        for first, second in pairs:
+            parents = [towers[first], towers[second]]
+            children.extend(crossover(parents) if self.index is None else validCrossover(parents, self.index))
+        return children
+
+    def mutate_batch(self, towers, mask, chance=MUTATION):
+        if self.index is None:
+            mutation(towers, mask, chance)
+        else:
+            validMutation(towers, mask, self.index, chance)
+
+    def key(self, tower):
+        return towerKey(tower)
+
+    def copy_state(self, tower):
+        return copyTower(tower)
+
+    def snapshot(self, towers, bestTower, bestFitness, generations, foundGen):
+        return towerSnapshot(towers, bestTower, generations, foundGen)
+
+    # Pick up where a checkpoint left off
+    def restore(self, snapshot):
+        if str(snapshot['engine']) != 'towers':
+            raise ValueError("checkpoint was written by the " + str(snapshot['engine']) + " engine, not towers")
+        restore_rng(snapshot)
+        towers = decodeTowers(self.pieces, snapshot['tower_ids'], snapshot['tower_ends'])
+        bestTower = towerFromKey(self.pieces, snapshot['best'])
+        return towers, bestTower, self.cache(bestTower), int(snapshot['generation']), int(snapshot['best_generation'])
+
 # Main genetic algorithm function
-def geneticAlgorithmTB(file, runTime, analysis=False):
-    # Parse tower building file and randomly generate states
-    pieces = towerBuildingParser(file)
-    towers = generateStates(pieces)
-    # Initialize best tower
-    towers.sort(key = lambda tower: fitness(tower))
-    bestTower = towers[len(towers) - 1]
-    # Initialize timer and number of generations
+def geneticAlgorithmTB(file, runTime, analysis=False, cache=None, workers=1, reporter=None, maxGenerations=None,
+                       stats=None, checkpoint=None, resume=None, stall=None, onStall='stop', onImprove=None,
+                       duplicates='drop', operators='valid', exact='off', scheduler=None, selection='roulette'):
+    # Every fitness lookup goes through the cache
+    if cache is None:
+        cache = towerCache()
+    # Print statistics every generation unless told otherwise
+    if reporter is None:
+        reporter = TextReporter(1, printer=statisticsPrinter(cache))
+    if stats is None:
+        stats = NullStats()
+    cacheMisses = cache.misses
+    # Parse tower building file, unless given the pieces themselves, and initialize timer
+    pieces = towerBuildingParser(file) if isinstance(file, str) else file
     endTime = time.time() + runTime
-    generations = 0
-    foundGen = 0
-    while time.time() < endTime:
-    # while loop used for generating analysis
-    # while generations < 20:
-        # Add best towers to next generation (elitism) and cull worst (culling)
-        nextTowers = elitism(towers)
-        towers = culling(towers)
-        # Get parents (selection) and add offspring to next generation (crossover)
-        while len(nextTowers) < SAMPLE_SIZE:
-            parents = selection(towers)
-            nextTowers.extend(crossover(parents))
-        # Apply chance mutations for each tower
-        nextTowers.sort(key = lambda tower: fitness(tower))
-        elites = elitism(nextTowers)
-        nextTowers = mutation(nextTowers, elites)
-        # Get best tower in next generation
-        nextTowers.sort(key = lambda tower: fitness(tower))
-        prevBestTower = copy.copy(bestTower)
-        bestTower = nextTowers[-1]
-        if fitness(bestTower) > fitness(prevBestTower) and bestTower.id != prevBestTower.id:
-            foundGen = generations
-        # print statistics every 10 generations
-        # if analysis and generations % 1 == 0:
-        printStatistics(bestTower, generations, foundGen)
-        # Reset towers and increment generations
-        towers = copy.copy(nextTowers)
-        generations = generations + 1
-    # print final statistics
-    # printStatistics(bestTower, generations, foundGen)
+    # Solve exactly instead of evolving, or seed the population with the exact solution
+    bestTower = exactTower(pieces) if exact != 'off' else None
+    if exact == 'only':
+        stats.count('fitness_evals', cache.misses - cacheMisses)
+        return bestTower, 0, 0
+    problem = TowerProblem(pieces, cache, operators=operators, seeds=[bestTower] if bestTower is not None else [])
+    # Spread crossover and fitness over worker processes if asked
+    if workers > 1:
+        problem.pool = towerPool(workers, pieces, problem.index)
+    try:
+        # Randomly generate states, or pick up where a checkpoint left off
+        ga = GeneticAlgorithm(problem, stats, duplicates, selection)
+        ga.start(resume, endTime)
+        bestTower, bestFitness, generations, foundGen = ga.run(endTime, reporter, maxGenerations, checkpoint, stall,
+                                                               onStall, onImprove, scheduler)
+    finally:
+        if problem.pool is not None:
+            problem.pool.close()
+    stats.count('fitness_evals', cache.misses - cacheMisses)
+    return bestTower, generations, foundGen
 
 if __name__ == "__main__":
     # genetic algorithm testing without command line arguments
@@ -0,0 +1,117 @@
+import glob
+import json
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+import NumberAllocation
+import TowerBuilding
+from reporting import NullReporter
+
+
+# Tell the problem of an instance file from its first line, pieces have four fields
+def detect_problem(path):
+    with open(path, 'r') as f:
+        return detect_lines(f, path)
+
+
+# Tell the problem of an instance from the lines of its text
+def detect_lines(lines, name='<input>'):
+    for line in lines:
+        fields = line.split()
+        if fields:
+            return 2 if len(fields) == 4 else 1
+    raise ValueError(name + " is empty")
+
+
+# Expand a directory, glob or manifest into (path, problem, time) tasks.
+# Manifest lines are "path [problem] [time]", relative paths are taken from the manifest's folder
+def find_instances(source, run_time):
+    if os.path.isdir(source):
+        paths = sorted(os.path.join(source, name) for name in os.listdir(source)
+                       if os.path.isfile(os.path.join(source, name)))
+        return [(path, None, run_time) for path in paths]
+    if glob.has_magic(source):
+        return [(path, None, run_time) for path in sorted(glob.glob(source)) if os.path.isfile(path)]
+
+    tasks = []
+    folder = os.path.dirname(source)
+    with open(source, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            path = os.path.join(folder, fields[0])
+            problem = int(fields[1]) if len(fields) > 1 else None
+            task_time = float(fields[2]) if len(fields) > 2 else run_time
+            tasks.append((path, problem, task_time))
+    return tasks
+
+
+# Solve one instance inside a worker process and describe the result as a dict, the options are
+# handed to run_instance
+def solve_instance(task):
+    path, problem, run_time, options = task
+    start = time.time()
+    result = {'file': path, 'problem': problem, 'time': run_time}
+    try:
+        if problem is None:
+            problem = result['problem'] = detect_problem(path)
+        if problem == 1:
+            instance = NumberAllocation.number_allocation_parser(path)
+        else:
+            instance = TowerBuilding.towerBuildingParser(path)
+        result.update(run_instance(problem, instance, run_time, **options))
+    except Exception as error:
+        result['error'] = type(error).__name__ + ": " + str(error)
+    result['seconds'] = time.time() - start
+    return result
+
+
+# Run the genetic algorithm on a parsed instance, the numbers or the pieces, returning the
+# solution, its fitness and the generations run and found on
+def run_instance(problem, instance, run_time, engine='classic', reporter=None, stall=None, bins=NumberAllocation.BINS,
+                 duplicates='drop', operators='valid', selection='roulette'):
+    if reporter is None:
+        reporter = NullReporter()
+    if problem == 1:
+        best_solution, best_fitness, generations, found_generation = NumberAllocation.find_best_allocation(
+            instance, run_time, reporter=reporter, stall=stall, bins=bins, duplicates=duplicates,
+            selection=selection, engine=engine)
+        solution = describe_solution(problem, best_solution)
+    else:
+        cache = TowerBuilding.towerCache()
+        best_tower, generations, found_generation = TowerBuilding.geneticAlgorithmTB(
+            instance, run_time, cache=cache, reporter=reporter, stall=stall, duplicates=duplicates,
+            operators=operators, selection=selection)
+        best_fitness = cache(best_tower) - TowerBuilding.FITNESS
+        solution = describe_solution(problem, best_tower)
+    return {
+        'solution': solution,
+        'best_fitness': float(best_fitness),
+        'generations': generations,
+        'found_generation': found_generation
+    }
+
+
+# A solution as plain lists for JSON, the bins or the pieces of the tower from the bottom up
+def describe_solution(problem, solution):
+    if problem == 1:
+        return solution.tolist()
+    return [[piece.type, piece.width, piece.strength, piece.cost] for piece in solution.pieces]
+
+
+# Solve every task across a worker pool, yielding results as each instance finishes. Options such
+# as the engine, bins, duplicates, operators and selection are handed to run_instance
+def run_batch(tasks, workers=1, **options):
+    with Pool(workers) as pool:
+        for result in pool.imap_unordered(solve_instance, [task + (options,) for task in tasks]):
+            yield result
+
+
+# Stream one JSON line per solved instance
+def print_batch(source, run_time, workers=1, stream=sys.stdout, **options):
+    for result in run_batch(find_instances(source, run_time), workers, **options):
+        stream.write(json.dumps(result) + '\n')
+        stream.flush()
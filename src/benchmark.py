@@ -0,0 +1,165 @@
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+
+import NumberAllocation
+import TowerBuilding
+from ga_utils import PhaseStats
+from reporting import NullReporter
+
+PIECE_TYPES = ["Door", "Wall", "Lookout"]
+
+
+# Generate a number allocation instance of count numbers, repeatable through the seed
+def generate_numbers(count, seed=0):
+    rng = random.Random(seed)
+    return [rng.randint(-10, 10) for _ in range(count)]
+
+
+# Generate a tower building instance of count pieces, repeatable through the seed
+def generate_pieces(count, seed=0):
+    rng = random.Random(seed)
+    pieces = []
+    for index in range(count):
+        width = rng.randint(1, max(2, count // 2))
+        pieces.append((PIECE_TYPES[index % 3], width, rng.randint(1, count), rng.randint(1, 10)))
+    return pieces
+
+
+def write_numbers(path, numbers):
+    with open(path, 'w') as f:
+        f.write('\n'.join(str(number) for number in numbers) + '\n')
+
+
+def write_pieces(path, pieces):
+    with open(path, 'w') as f:
+        f.write('\n'.join(' '.join(str(field) for field in piece) for piece in pieces) + '\n')
+
+
+# Reporter recording the best fitness, less offset, against elapsed time whenever it improves
+class HistoryReporter(NullReporter):
+    def __init__(self, offset=0):
+        self.start = time.perf_counter()
+        self.offset = offset
+        self.history = []
+
+    def update(self, generation, best, best_fitness, found_generation, diversity=None):
+        best_fitness = float(best_fitness - self.offset)
+        if not self.history or best_fitness > self.history[-1][2]:
+            self.history.append((time.perf_counter() - self.start, generation, best_fitness))
+
+
+# Run one benchmark case for a fixed number of generations and measure it
+def run_case(problem, engine, size, generations, seed, sample_size=None, selection='roulette'):
+    random.seed(seed)
+    np.random.seed(seed)
+    # Tower fitness is reported as the score, without the offset keeping it positive
+    reporter = HistoryReporter(TowerBuilding.FITNESS if problem == 2 else 0)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'instance.txt')
+        start = time.perf_counter()
+        if problem == 1:
+            write_numbers(path, generate_numbers(size, seed))
+            number_list = NumberAllocation.number_allocation_parser(path)
+            cache = NumberAllocation.allocation_cache()
+            stats = PhaseStats()
+            result = NumberAllocation.find_best_allocation(number_list, float('inf'), cache, reporter=reporter,
+                                                           max_generations=generations, stats=stats,
+                                                           selection=selection, engine=engine,
+                                                           sample_size=sample_size or NumberAllocation.SAMPLE_SIZE)
+            # The array engines have no cache, every state they rank is evaluated
+            fitness_evals = cache.misses if engine == 'classic' else stats.counts['fitness_calls']
+            best_fitness, generations_run = result[1], result[2]
+        else:
+            write_pieces(path, generate_pieces(size, seed))
+            cache = TowerBuilding.towerCache()
+            best_tower, generations_run, found_gen = TowerBuilding.geneticAlgorithmTB(
+                path, float('inf'), cache=cache, reporter=reporter, maxGenerations=generations, selection=selection)
+            best_fitness = cache(best_tower) - TowerBuilding.FITNESS
+            fitness_evals = cache.misses
+        elapsed = time.perf_counter() - start
+
+    return {
+        'problem': problem,
+        'engine': engine,
+        'selection': selection,
+        'size': size,
+        'sample_size': sample_size,
+        'seed': seed,
+        'generations': generations_run,
+        'seconds': elapsed,
+        'generations_per_sec': generations_run / elapsed,
+        'fitness_evals': fitness_evals,
+        'fitness_evals_per_sec': fitness_evals / elapsed,
+        'peak_memory_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'best_fitness': float(best_fitness),
+        'history': reporter.history
+    }
+
+
+# Run every case in a fresh process so peak memory belongs to that case alone
+def run_cases(cases, generations, seed):
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for problem, engine, size, sample_size, selection in cases:
+        with context.Pool(1) as pool:
+            results.append(pool.apply(run_case, (problem, engine, size, generations, seed, sample_size, selection)))
+        print("Problem " + str(problem) + " " + engine + " " + selection + " size " + str(size) +
+              (" sample size " + str(sample_size) if sample_size else "") + ": " +
+              "%.1f generations/sec, best fitness %s" % (results[-1]['generations_per_sec'], results[-1]['best_fitness']))
+    return results
+
+
+# Current commit of the repository, if there is one
+def current_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--problems', help="--problems : which problems to run", type=int, nargs='+',
+                        choices=[1, 2], default=[1, 2])
+    parser.add_argument('--engines', help="--engines : number allocation engines to run", type=str, nargs='+',
+                        choices=['classic', 'vectorized', 'permutation'], default=['classic', 'vectorized', 'permutation'])
+    parser.add_argument('--selections', help="--selections : parent selection strategies to run", type=str,
+                        nargs='+', choices=['roulette', 'tournament', 'rank'], default=['roulette'])
+    parser.add_argument('--number-sizes', help="--number-sizes : numbers per allocation instance", type=int,
+                        nargs='+', default=[40])
+    parser.add_argument('--piece-sizes', help="--piece-sizes : pieces per tower instance", type=int, nargs='+',
+                        default=[10, 100])
+    parser.add_argument('--sample-sizes', help="--sample-sizes : population sizes for the array engines",
+                        type=int, nargs='+', default=[NumberAllocation.SAMPLE_SIZE])
+    parser.add_argument('--generations', help="--generations : generations per case", type=int, default=50)
+    parser.add_argument('--seed', help="--seed : seed for instances and runs", type=int, default=0)
+    parser.add_argument('--output', help="--output : json file the results are written to", type=str,
+                        default='benchmark.json')
+    args = parser.parse_args()
+
+    cases = []
+    for selection in args.selections:
+        if 1 in args.problems:
+            for engine in args.engines:
+                for size in args.number_sizes:
+                    for sample_size in ([None] if engine == 'classic' else args.sample_sizes):
+                        cases.append((1, engine, size, sample_size, selection))
+        if 2 in args.problems:
+            for size in args.piece_sizes:
+                cases.append((2, 'classic', size, None, selection))
+
+    results = run_cases(cases, args.generations, args.seed)
+    with open(args.output, 'w') as f:
+        json.dump({'commit': current_commit(), 'time': time.time(), 'generations': args.generations,
+                   'seed': args.seed, 'results': results}, f, indent=2)
@@ -0,0 +1,77 @@
+import sys
+
+import numpy as np
+
+import NumberAllocation
+from ga_utils import SELECTIONS
+
+# Constants
+TRIALS = 200
+POPULATION = 30
+PAIRS = 50
+
+
+# Random input numbers that split evenly into the bins, with plenty of repeats
+def random_numbers(bins):
+    count = bins * np.random.randint(1, 12)
+    return np.random.randint(-5, 6, size=count).astype(float)
+
+
+# Check every repaired child of the bin crossover holds exactly the input numbers
+def check_repair(trials=TRIALS):
+    failures = 0
+    for trial in range(trials):
+        bins = np.random.randint(3, 7)
+        values = random_numbers(bins)
+        population = NumberAllocation.initialize_population_array(values, POPULATION, bins)
+        pairs = np.random.randint(POPULATION, size=(PAIRS, 2))
+        offsprings = NumberAllocation.crossover_batch(population, pairs)
+        NumberAllocation.repair_batch(offsprings, *NumberAllocation.gen_occurrence_arrays(values))
+        expected = np.sort(values)
+        for offspring in offsprings:
+            if not np.array_equal(np.sort(offspring.ravel()), expected):
+                failures += 1
+                print("Repair trial " + str(trial) + ": child holds " + str(np.sort(offspring.ravel())))
+    return failures
+
+
+# Check every child of the order crossover is a permutation of the input indexes
+def check_order_crossover(trials=TRIALS):
+    failures = 0
+    for trial in range(trials):
+        length = np.random.randint(1, 40)
+        population = NumberAllocation.initialize_permutations(length, POPULATION)
+        pairs = np.random.randint(POPULATION, size=(PAIRS, 2))
+        out = np.empty((2 * PAIRS, length), dtype=population.dtype)
+        children = NumberAllocation.order_crossover_batch(population, pairs, out)
+        for child in children:
+            if not np.array_equal(np.sort(child), np.arange(length)):
+                failures += 1
+                print("Order crossover trial " + str(trial) + ": child " + str(child))
+    return failures
+
+
+# Check every selection strategy draws distinct parents in range, with as few as two states and
+# with scores that are negative, equal or not finite
+def check_selection(trials=TRIALS):
+    failures = 0
+    for trial in range(trials):
+        count = 2 if trial % 4 == 0 else np.random.randint(2, POPULATION)
+        fit_vals = np.random.choice([-3.0, 0.0, 0.0, 1.0, 7.0, 1e300, np.inf, -np.inf, np.nan], size=count)
+        for name, select_pairs in SELECTIONS.items():
+            pairs = select_pairs(fit_vals, PAIRS)
+            if pairs.shape != (PAIRS, 2) or (pairs < 0).any() or (pairs >= count).any() or \
+                    (pairs[:, 0] == pairs[:, 1]).any():
+                failures += 1
+                print("Selection trial " + str(trial) + ": " + name + " drew " + str(pairs.tolist()) + " from " +
+                      str(fit_vals.tolist()))
+    return failures
+
+
+if __name__ == '__main__':
+    # Run every check on random inputs, the optional argument gives the number of trials
+    np.random.seed(1)
+    trials = int(sys.argv[1]) if len(sys.argv) > 1 else TRIALS
+    failures = check_repair(trials) + check_order_crossover(trials) + check_selection(trials)
+    print(str(failures) + " failures in " + str(trials) + " trials")
+    sys.exit(1 if failures else 0)
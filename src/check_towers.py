@@ -0,0 +1,87 @@
+import itertools
+import random
+import sys
+
+import numpy as np
+
+from TowerBuilding import *
+
+# Constants
+TRIALS = 200
+ROUNDS = 5
+POPULATION = 20
+BRUTE_PIECES = 7
+
+# Random piece set of the given size, mostly walls so valid towers are common, with the odd
+# piece of negative strength
+def randomPieces(count):
+    return [Piece(random.choice(["Door", "Wall", "Wall", "Lookout"]), random.randint(1, 5), random.randint(-1, 5),
+                  random.randint(0, 8), id) for id in range(count)]
+
+# Compare the running totals fitness keeps against a full rescan, after every round of mutation
+def checkMutations(trials=TRIALS):
+    failures = 0
+    for trial in range(trials):
+        pieces = randomPieces(random.randint(2, 9))
+        index = PieceIndex(pieces)
+        towers = generateStates(pieces, POPULATION)
+        validTowers = generateValidStates(index, POPULATION) if index.doors else []
+        mask = np.random.random(POPULATION) < 0.8
+        for round in range(ROUNDS):
+            # Counting the towers first makes the mutations update the totals in place
+            for tower in towers + validTowers:
+                fitness(tower)
+            mutation(towers, mask, 1.0)
+            if validTowers:
+                validMutation(validTowers, mask, index, 1.0)
+            for tower in towers + validTowers:
+                if fitness(tower) != scanFitness(tower):
+                    failures += 1
+                    print("Mutation trial " + str(trial) + ": fitness " + str(fitness(tower)) +
+                          " but a rescan gives " + str(scanFitness(tower)) + " for " + str(towerKey(tower)))
+    return failures
+
+# Best score of any valid tower, trying every ordering of every subset of the pieces
+def bruteForceScore(pieces):
+    best = None
+    for height in range(2, len(pieces) + 1):
+        for order in itertools.permutations(pieces, height):
+            tower = Tower(0)
+            tower.setPieces(order)
+            if validTower(tower) and (best is None or scanFitness(tower) > best):
+                best = scanFitness(tower)
+    return best
+
+# Compare the exact solver against brute force, and check the valid operators only make valid towers
+def checkExact(trials=TRIALS):
+    failures = 0
+    for trial in range(trials):
+        pieces = randomPieces(random.randint(2, BRUTE_PIECES))
+        expected = bruteForceScore(pieces)
+        tower = exactTower(pieces)
+        score = scanFitness(tower) if tower is not None and validTower(tower) else None
+        if score != expected:
+            failures += 1
+            print("Exact trial " + str(trial) + ": exactTower scores " + str(score) + " but brute force finds " +
+                  str(expected))
+
+        index = PieceIndex(pieces)
+        if not index.doors:
+            continue
+        towers = generateValidStates(index, POPULATION)
+        towers.extend(validCrossover([towers[0], towers[-1]], index))
+        validMutation(towers, np.ones(len(towers), dtype=bool), index, 1.0)
+        for tower in towers:
+            if not validTower(tower):
+                failures += 1
+                print("Operator trial " + str(trial) + ": invalid tower " + str(towerKey(tower)))
+    return failures
+
+if __name__ == "__main__":
+    # Run every check on random piece sets, the optional argument gives the number of trials
+    random.seed(1)
+    np.random.seed(1)
+    trials = int(sys.argv[1]) if len(sys.argv) > 1 else TRIALS
+    failures = checkMutations(trials) + checkExact(trials)
+    print(str(failures) + " failures in " + str(trials) + " trials")
+    sys.exit(1 if failures else 0)
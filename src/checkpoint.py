@@ -0,0 +1,90 @@
+import os
+import random
+import threading
+import time
+
+import numpy as np
+
+# Constants
+CHECKPOINT_SECONDS = 5.0
+
+
+# Capture the state of both random number generators as plain arrays
+def rng_snapshot():
+    version, internal, gauss_next = random.getstate()
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return {
+        'random_version': version,
+        'random_internal': np.array(internal, dtype=np.int64),
+        'random_gauss': np.nan if gauss_next is None else gauss_next,
+        'np_keys': keys,
+        'np_pos': pos,
+        'np_has_gauss': has_gauss,
+        'np_gauss': cached_gaussian
+    }
+
+
+# Put both random number generators back to the state held in a snapshot
+def restore_rng(snapshot):
+    gauss_next = float(snapshot['random_gauss'])
+    random.setstate((int(snapshot['random_version']),
+                     tuple(int(value) for value in snapshot['random_internal']),
+                     None if np.isnan(gauss_next) else gauss_next))
+    np.random.set_state(('MT19937', snapshot['np_keys'], int(snapshot['np_pos']),
+                         int(snapshot['np_has_gauss']), float(snapshot['np_gauss'])))
+
+
+# Write a snapshot of arrays to path, going through a temporary file so a
+# reader never sees a half written checkpoint
+def write_checkpoint(path, snapshot):
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as f:
+        np.savez(f, **snapshot)
+    os.replace(temp_path, path)
+
+
+# Load a snapshot written by write_checkpoint, scalars come back as numpy scalars
+def load_checkpoint(path):
+    with np.load(path, allow_pickle=False) as data:
+        return {key: data[key][()] if data[key].ndim == 0 else data[key] for key in data.files}
+
+
+# Writes snapshots from a background thread at most once every interval seconds,
+# only the newest snapshot waiting to be written is kept
+class CheckpointWriter:
+    def __init__(self, path, interval=CHECKPOINT_SECONDS):
+        self.path = path
+        self.interval = interval
+        self.last_time = time.monotonic()
+        self.pending = None
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.write_snapshots, daemon=True)
+        self.thread.start()
+
+    def due(self):
+        return time.monotonic() - self.last_time >= self.interval
+
+    # Queue a snapshot, which must not share memory with anything still changing
+    def save(self, snapshot):
+        self.last_time = time.monotonic()
+        with self.condition:
+            self.pending = snapshot
+            self.condition.notify()
+
+    def write_snapshots(self):
+        while True:
+            with self.condition:
+                while self.pending is None and not self.closed:
+                    self.condition.wait()
+                snapshot, self.pending = self.pending, None
+                if snapshot is None:
+                    return
+            write_checkpoint(self.path, snapshot)
+
+    # Wait for the last queued snapshot to be written
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
@@ -1,6 +1,14 @@
 import argparse
+import cProfile
+import time
 from NumberAllocation import *
 from TowerBuilding import *
+from islands import run_islands
+from batch import print_batch
+from service import serve
+from reporting import make_reporter
+from ga_utils import BudgetScheduler, PhaseStats, StallMonitor
+from checkpoint import CheckpointWriter, load_checkpoint
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -9,32 +17,328 @@ if __name__ == '__main__':
         'problem',
         help="--problem : the problem you want to do",
         type=int,
-        choices=[1, 2]
+        choices=[1, 2],
+        nargs='?'
     )
     parser.add_argument(
         'file',
         help="--file : the name of the file you want to be read in",
-        type=str
+        type=str,
+        nargs='?'
     )
     parser.add_argument(
         'time',
         help="--time : the amount of time to run the problem",
+        type=int,
+        nargs='?'
+    )
+
+    parser.add_argument(
+        '--engine',
+        help="--engine : the number allocation engine to use",
+        type=str,
+        choices=['classic', 'vectorized', 'permutation'],
+        default='classic'
+    )
+
+    parser.add_argument(
+        '--bins',
+        help="--bins : the number of bins to split the numbers into, the numbers must divide evenly",
+        type=int,
+        default=4
+    )
+
+    parser.add_argument(
+        '--duplicates',
+        help="--duplicates : what to do with clones of an individual already in the generation",
+        type=str,
+        choices=['keep', 'drop', 'mutate'],
+        default='drop'
+    )
+
+    parser.add_argument(
+        '--selection',
+        help="--selection : how parents are chosen, by fitness share, by tournament or by fitness rank",
+        type=str,
+        choices=['roulette', 'tournament', 'rank'],
+        default='roulette'
+    )
+
+    parser.add_argument(
+        '--operators',
+        help="--operators : tower building operators, valid ones only ever make towers that pass the rules",
+        type=str,
+        choices=['valid', 'random'],
+        default='valid'
+    )
+    parser.add_argument(
+        '--exact',
+        help="--exact : solve tower building exactly, on its own or to seed the population",
+        type=str,
+        choices=['off', 'seed', 'only'],
+        default='off'
+    )
+
+    parser.add_argument(
+        '--workers',
+        help="--workers : the number of worker processes for fitness and offspring",
+        type=int,
+        default=1
+    )
+
+    parser.add_argument(
+        '--islands',
+        help="--islands : the number of independent populations, one per process",
+        type=int,
+        default=1
+    )
+    parser.add_argument(
+        '--migration-interval',
+        help="--migration-interval : the generations between island migrations",
+        type=int,
+        default=10
+    )
+    parser.add_argument(
+        '--migration-size',
+        help="--migration-size : the number of best individuals each island sends out",
+        type=int,
+        default=5
+    )
+    parser.add_argument(
+        '--topology',
+        help="--topology : which islands receive each island's migrants",
+        type=str,
+        choices=['ring', 'full'],
+        default='ring'
+    )
+
+    parser.add_argument(
+        '--report',
+        help="--report : how to report progress, defaults to text for problem 2 and none for problem 1",
+        type=str,
+        choices=['none', 'text', 'jsonl']
+    )
+    parser.add_argument(
+        '--report-every',
+        help="--report-every : report every N generations",
+        type=int
+    )
+    parser.add_argument(
+        '--report-seconds',
+        help="--report-seconds : report at most every T seconds",
+        type=float
+    )
+    parser.add_argument(
+        '--report-file',
+        help="--report-file : where jsonl events are written, - for stdout",
+        type=str,
+        default='-'
+    )
+
+    parser.add_argument(
+        '--profile',
+        help="--profile : print the time spent in each phase of the generation loop",
+        action='store_true'
+    )
+    parser.add_argument(
+        '--profile-out',
+        help="--profile-out : also run under cProfile and dump pstats to this file",
+        type=str
+    )
+
+    parser.add_argument(
+        '--checkpoint',
+        help="--checkpoint : file the population is periodically saved to",
+        type=str
+    )
+    parser.add_argument(
+        '--checkpoint-seconds',
+        help="--checkpoint-seconds : seconds between checkpoints",
+        type=float,
+        default=5.0
+    )
+    parser.add_argument(
+        '--resume',
+        help="--resume : checkpoint file to continue a run from",
+        type=str
+    )
+
+    parser.add_argument(
+        '--stall-generations',
+        help="--stall-generations : treat the run as stalled after N generations without improvement",
         type=int
     )
+    parser.add_argument(
+        '--stall-seconds',
+        help="--stall-seconds : treat the run as stalled after T seconds without improvement",
+        type=float
+    )
+    parser.add_argument(
+        '--min-diversity',
+        help="--min-diversity : treat the run as stalled when the fraction of distinct individuals drops below this",
+        type=float
+    )
+    parser.add_argument(
+        '--on-stall',
+        help="--on-stall : stop early or restart around the elites when the run stalls",
+        type=str,
+        choices=['stop', 'restart'],
+        default='stop'
+    )
+    parser.add_argument(
+        '--anytime',
+        help="--anytime : print the best fitness every time it improves",
+        action='store_true'
+    )
+
+    parser.add_argument(
+        '--auto-size',
+        help="--auto-size : pick the population size, elitism and culling for the time after a short warm-up",
+        action='store_true'
+    )
+    parser.add_argument(
+        '--target-generations',
+        help="--target-generations : the generations --auto-size sizes the population to fit in the time",
+        type=int,
+        default=200
+    )
+
+    parser.add_argument(
+        '--batch',
+        help="--batch : directory, glob or manifest of instance files to solve across --workers processes",
+        type=str
+    )
+    parser.add_argument(
+        '--batch-time',
+        help="--batch-time : seconds per instance in batch mode, unless the manifest gives one",
+        type=float,
+        default=10
+    )
+
+    parser.add_argument(
+        '--serve',
+        help="--serve : run as a solver service on host:port or a Unix socket path, with --workers processes",
+        type=str
+    )
 
     args = parser.parse_args()
+
+    # Batch mode streams a JSON line per instance instead of the usual output
+    if args.batch is not None:
+        print_batch(args.batch, args.batch_time, args.workers, engine=args.engine, bins=args.bins,
+                    duplicates=args.duplicates, operators=args.operators, selection=args.selection)
+        raise SystemExit
+    # Service mode answers JSON line requests until interrupted
+    if args.serve is not None:
+        serve(args.serve, args.workers)
+        raise SystemExit
+    if args.problem is None or args.file is None or args.time is None:
+        parser.error("problem, file and time are required unless --batch or --serve is given")
+    if args.islands > 1 and args.exact == 'only':
+        parser.error("--exact only solves without evolving, so it cannot run on --islands")
+    # Islands run their own loops in their own processes, without these options
+    if args.islands > 1:
+        island_options = {
+            '--checkpoint': args.checkpoint is not None,
+            '--resume': args.resume is not None,
+            '--stall-generations': args.stall_generations is not None,
+            '--stall-seconds': args.stall_seconds is not None,
+            '--min-diversity': args.min_diversity is not None,
+            '--anytime': args.anytime,
+            '--auto-size': args.auto_size,
+            '--report': args.report not in (None, 'none'),
+            '--workers': args.workers > 1
+        }
+        given = [option for option, used in island_options.items() if used]
+        if given:
+            parser.error(", ".join(given) + " cannot be used with --islands")
+
     print("Problem: " + str(args.problem))
     print("Filename: " + args.file)
     print("Time: " + str(args.time))
 
-    if args.problem == 1:
+    stats = PhaseStats() if args.profile else None
+    checkpoint = CheckpointWriter(args.checkpoint, args.checkpoint_seconds) if args.checkpoint else None
+    resume = load_checkpoint(args.resume) if args.resume else None
+    stall = None
+    if args.stall_generations is not None or args.stall_seconds is not None or args.min_diversity is not None:
+        stall = StallMonitor(args.stall_generations, args.stall_seconds, args.min_diversity)
+    on_improve = None
+    if args.anytime:
+        start_time = time.time()
+        # Tower fitness is shown as the score, without the offset keeping it positive
+        offset = FITNESS if args.problem == 2 else 0
+        on_improve = lambda best, fitness, generation: print(
+            "Improved at %.2f s, generation %d: %s" % (time.time() - start_time, generation, fitness - offset))
+    scheduler = BudgetScheduler(args.target_generations) if args.auto_size else None
+    profiler = cProfile.Profile() if args.profile_out else None
+    if profiler is not None:
+        profiler.enable()
+
+    if args.islands > 1:
+        best_stats, island_stats = run_islands(args.problem, args.file, args.time, args.islands,
+                                               args.migration_interval, args.migration_size, args.topology,
+                                               stats, engine=args.engine, bins=args.bins, duplicates=args.duplicates,
+                                               selection=args.selection, operators=args.operators,
+                                               exact=args.exact)
+        for island in island_stats:
+            print("Island " + str(island['island']) + ": best fitness " + str(island['best_fitness']) +
+                  ", generations " + str(island['generations']) + ", found on " + str(island['best_generation']) +
+                  ", migrants received " + str(island['received']))
+        print("Best island: " + str(best_stats['island']))
+        if args.problem == 1:
+            print("Best Solution: ")
+            print(best_stats['best'])
+            print("Best fitness: ", best_stats['best_fitness'])
+        else:
+            print("Best Solution:")
+            printState(best_stats['best'])
+    elif args.problem == 1:
         list = number_allocation_parser(args.file)
-        best_solution, best_fitness, gen_num, gen_found = find_best_allocation(list, args.time)
+        cache = allocation_cache()
+        reporter = make_reporter(args.report, args.report_every, args.report_seconds, args.report_file)
+        best_solution, best_fitness, gen_num, gen_found = \
+            find_best_allocation(list, args.time, cache, args.workers, reporter, stats=stats, checkpoint=checkpoint,
+                                 resume=resume, stall=stall, on_stall=args.on_stall, on_improve=on_improve,
+                                 bins=args.bins, duplicates=args.duplicates, scheduler=scheduler,
+                                 selection=args.selection, engine=args.engine)
+        reporter.close()
         print("Best Solution: ")
         print(best_solution)
         print("Best fitness: ", best_fitness)
         print("Generations ran through: ", gen_num)
         print("Generation found on: ", gen_found)
+        if args.engine == 'classic':
+            print("Fitness cache hits: ", cache.hits)
+            print("Fitness cache misses: ", cache.misses)
     elif args.problem == 2:
         print("Do problem 2!")
-        geneticAlgorithmTB(args.file, args.time)
+        cache = towerCache()
+        reporter = None
+        if args.report is not None:
+            reporter = make_reporter(args.report, args.report_every, args.report_seconds, args.report_file,
+                                     statisticsPrinter(cache))
+        best_tower, gen_num, gen_found = geneticAlgorithmTB(args.file, args.time, cache=cache, workers=args.workers,
+                                                            reporter=reporter, stats=stats, checkpoint=checkpoint,
+                                                            resume=resume, stall=stall, onStall=args.on_stall,
+                                                            onImprove=on_improve, duplicates=args.duplicates,
+                                                            operators=args.operators, exact=args.exact,
+                                                            scheduler=scheduler, selection=args.selection)
+        if best_tower is None:
+            print("No valid tower can be built from these pieces")
+        elif args.exact == 'only':
+            print("Best Solution:")
+            printState(best_tower, cache)
+        elif reporter is not None:
+            reporter.close()
+            printStatistics(best_tower, gen_num, gen_found, cache)
+        print("Fitness cache hits: " + str(cache.hits))
+        print("Fitness cache misses: " + str(cache.misses))
+
+    if checkpoint is not None:
+        checkpoint.close()
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile_out)
+    if stats is not None:
+        stats.print_breakdown()
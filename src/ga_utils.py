@@ -1,61 +1,725 @@
-import random
-
-
-# Get elite states to save through elitism
-def elitism(population, elite_num):
-    elites = []
-    for index in range(elite_num):
-        elites.append(population[-index - 1])
-    return elites
-
-
-# Remove weakest states through culling
-def culling(population, culling_num):
-    not_culled = []
-    for index in range(len(population) - culling_num):
-        not_culled.append(population[-index - 1])
-    return not_culled
-
-
-# Get summed fitness for given population
-def get_summed_fitness(population, fit_func):
-    total = 0
-    for state in population:
-        fit_val = fit_func(state)
-        total = total + abs(fit_val)
-    return total
-
-
-# Get chance of parent selection for given population
-def get_selection_chances(population, total_fitness, fit_func):
-    sel_chances = []
-    for state in population:
-        fit_val = fit_func(state)
-        sel_chances.append(fit_val / total_fitness)
-    return sel_chances
-
-
-# Select parents with weighting towards higher fitness
-def selection(population, fit_func, towers=True):
-    parents = []
-    total_fitness = get_summed_fitness(population, fit_func)
-    sel_chances = get_selection_chances(population, total_fitness, fit_func)
-
-    parent_indexes = []
-    while len(parents) < 2:
-        random_num = random.random()
-        cumulative_prob = 0
-        for index in range(len(sel_chances)):
-            cumulative_prob = cumulative_prob + sel_chances[index]
-            if random_num < cumulative_prob and len(parents) == 1 and\
-                    ((towers and parents[0].id != population[index].id) or
-                     (not towers and index not in parent_indexes)):
-                parents.append(population[index])
-                parent_indexes.append(index)
-                break
-            elif random_num < cumulative_prob and len(parents) == 0:
-                parents.append(population[index])
-                parent_indexes.append(index)
+import copy
+import math
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from reporting import NullReporter
+
+# Constants
+CACHE_SIZE = 4096
+DUPLICATE_ATTEMPTS = 3
+SELECTION_ATTEMPTS = 8
+TOURNAMENT_SIZE = 3
+RANK_PRESSURE = 1.5
+OFFSPRING_CHUNKS = 8
+OVERRUN_FRACTION = 0.1
+WARMUP_GENERATIONS = 3
+WARMUP_FRACTION = 0.05
+TARGET_GENERATIONS = 200
+MIN_SAMPLE_SIZE = 20
+MAX_SAMPLE_SIZE = 20000
+MAX_ELITE_FRACTION = 0.5
+MAX_CULLING_FRACTION = 0.9
+
+
+# Bounded least-recently-used cache of fitness values keyed on the genome
+class FitnessCache:
+    def __init__(self, fit_func, key_func, max_size=CACHE_SIZE):
+        self.fit_func = fit_func
+        self.key_func = key_func
+        self.max_size = max_size
+        self.values = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, state):
+        key = self.key_func(state)
+        if key in self.values:
+            self.hits += 1
+            self.values.move_to_end(key)
+            return self.values[key]
+        self.misses += 1
+        fit_val = self.fit_func(state)
+        self.values[key] = fit_val
+        if len(self.values) > self.max_size:
+            self.values.popitem(last=False)
+        return fit_val
+
+    def __contains__(self, state):
+        return self.key_func(state) in self.values
+
+    # Store a fitness value computed elsewhere, such as in a worker process, counted as a miss
+    # since it was evaluated rather than found
+    def put(self, state, fit_val):
+        self.misses += 1
+        key = self.key_func(state)
+        self.values[key] = fit_val
+        self.values.move_to_end(key)
+        if len(self.values) > self.max_size:
+            self.values.popitem(last=False)
+
+    # Make room for at least max_size values, such as when the population grows
+    def grow(self, max_size):
+        self.max_size = max(self.max_size, max_size)
+
+    def clear(self):
+        self.values.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+# Ranking of a population by fitness, computed once per generation so elitism,
+# culling, selection and best tracking share it instead of sorting the population
+class Ranking:
+    def __init__(self, fit_vals):
+        self.fit_vals = np.asarray(fit_vals, dtype=float)
+
+    def __len__(self):
+        return len(self.fit_vals)
+
+    # Indexes of the count fittest states, fittest first
+    def top(self, count):
+        count = min(max(count, 0), len(self))
+        if count == 0:
+            return np.empty(0, dtype=np.intp)
+        top = np.argpartition(self.fit_vals, len(self) - count)[len(self) - count:]
+        return top[np.argsort(-self.fit_vals[top], kind='stable')]
+
+    # Indexes of the count weakest states, in no particular order
+    def bottom(self, count):
+        count = min(max(count, 0), len(self))
+        if count == 0:
+            return np.empty(0, dtype=np.intp)
+        return np.argpartition(self.fit_vals, count - 1)[:count]
+
+    # Indexes of the states left after removing the count weakest
+    def survivors(self, count):
+        count = min(max(count, 0), len(self))
+        if count == 0:
+            return np.arange(len(self))
+        return np.argpartition(self.fit_vals, count - 1)[count:]
+
+    # Index of the fittest state
+    def best(self):
+        return int(np.argmax(self.fit_vals))
+
+
+# Stats object that ignores everything, used when profiling is turned off
+class NullStats:
+    def start(self):
+        pass
+
+    def lap(self, phase):
+        pass
+
+    def count(self, counter, amount=1):
+        pass
+
+
+# Time spent in each phase of the generation loop and counters of its work
+class PhaseStats(NullStats):
+    def __init__(self):
+        self.times = {}
+        self.counts = {}
+        self.last_time = time.perf_counter()
+
+    # Mark the start of a stretch of work to be charged to the next lap
+    def start(self):
+        self.last_time = time.perf_counter()
+
+    # Charge the time since the last mark to the given phase
+    def lap(self, phase):
+        now = time.perf_counter()
+        self.times[phase] = self.times.get(phase, 0.0) + now - self.last_time
+        self.last_time = now
+
+    def count(self, counter, amount=1):
+        self.counts[counter] = self.counts.get(counter, 0) + amount
+
+    # Add in the times and counts of another run, such as one in another process
+    def merge(self, times, counts):
+        for phase, seconds in times.items():
+            self.times[phase] = self.times.get(phase, 0.0) + seconds
+        for counter, amount in counts.items():
+            self.count(counter, amount)
+
+    def print_breakdown(self):
+        total = sum(self.times.values()) or 1.0
+        print("Phase breakdown:")
+        for phase, seconds in sorted(self.times.items(), key=lambda item: -item[1]):
+            print("  %-10s %9.3f s %6.1f%%" % (phase, seconds, 100 * seconds / total))
+        for counter, amount in sorted(self.counts.items()):
+            print("  %-18s %d" % (counter, amount))
+
+
+# Watches the best fitness, and optionally population diversity, to tell when a run has stalled
+class StallMonitor:
+    def __init__(self, generations=None, seconds=None, min_diversity=None):
+        self.generations = generations
+        self.seconds = seconds
+        self.min_diversity = min_diversity
+        self.best_fitness = None
+        self.last_generation = 0
+        self.last_time = time.monotonic()
+
+    # Record a generation, diversity is a function only called when a minimum is set
+    def update(self, generation, best_fitness, diversity=None):
+        now = time.monotonic()
+        if self.best_fitness is None or best_fitness > self.best_fitness:
+            self.best_fitness = best_fitness
+            self.last_generation = generation
+            self.last_time = now
+        if self.generations is not None and generation - self.last_generation >= self.generations:
+            return True
+        if self.seconds is not None and now - self.last_time >= self.seconds:
+            return True
+        if self.min_diversity is not None and diversity is not None and diversity() < self.min_diversity:
+            return True
+        return False
+
+    # Start counting again after the population was restarted
+    def reset(self, generation):
+        self.last_generation = generation
+        self.last_time = time.monotonic()
+
+
+# Picks the sample size, elitism and culling for a time budget from the cost of a few warm-up
+# generations, aiming for target_generations generations in the time left. Runs too short to get
+# there even at min_size keep up to twice the elites and cull up to twice as hard, to make the
+# most of the generations they have
+class BudgetScheduler:
+    def __init__(self, target_generations=TARGET_GENERATIONS, warmup=WARMUP_GENERATIONS, min_size=MIN_SAMPLE_SIZE,
+                 max_size=MAX_SAMPLE_SIZE):
+        self.target_generations = target_generations
+        self.warmup = warmup
+        self.min_size = min_size
+        self.max_size = max_size
+        self.planned = False
+
+    # Start timing the warm-up of a run ending at deadline
+    def start(self, deadline):
+        self.deadline = deadline
+        self.start_time = time.time()
+        self.warmup_end = self.start_time + WARMUP_FRACTION * (deadline - self.start_time)
+        self.generations = 0
+        self.states = 0
+        self.planned = False
+
+    # Record a generation, resizing the problem once the warm-up is over
+    def update(self, ga):
+        if self.planned:
+            return
+        problem = ga.problem
+        self.generations += 1
+        self.states += problem.sample_size
+        now = time.time()
+        if self.generations < self.warmup and now < self.warmup_end:
+            return
+        self.planned = True
+        remaining = self.deadline - now
+        state_seconds = (now - self.start_time) / self.states
+        if remaining <= 0 or not math.isfinite(remaining) or state_seconds <= 0:
+            return
+
+        max_size = self.max_size
+        if problem.max_sample_size is not None:
+            max_size = min(max_size, problem.max_sample_size)
+        size = int(remaining / (self.target_generations * state_seconds))
+        size = max(self.min_size, min(size, max_size))
+        reach = min(1.0, remaining / (size * state_seconds) / self.target_generations)
+        elite_fraction = min(MAX_ELITE_FRACTION, (2 - reach) * problem.elite_num / problem.sample_size)
+        culling_fraction = min(MAX_CULLING_FRACTION, (2 - reach) * problem.culling_num / problem.sample_size)
+        problem.resize(size, elite_fraction, culling_fraction)
+        ga.stats.count('auto_sample_size', size)
+
+
+# Per-generation hash index of genomes, used to spot clones before they are evaluated
+class GenomeIndex:
+    def __init__(self, key_func):
+        self.key_func = key_func
+        self.keys = set()
+
+    def __len__(self):
+        return len(self.keys)
+
+    # Index a state, returning False when an identical one is already indexed
+    def add(self, state):
+        key = self.key_func(state)
+        if key in self.keys:
+            return False
+        self.keys.add(key)
+        return True
+
+
+# Indexes of the rows of a population array repeating an earlier row
+def duplicate_rows(population):
+    flat = np.ascontiguousarray(population.reshape((len(population), -1)))
+    rows = flat.view(np.dtype((np.void, flat.dtype.itemsize * flat.shape[1]))).ravel()
+    repeated = np.ones(len(population), dtype=bool)
+    repeated[np.unique(rows, return_index=True)[1]] = False
+    return np.flatnonzero(repeated)
+
+
+# Build the cumulative roulette table from the fitness of each state
+def get_selection_table(fit_vals):
+    weights = np.array(fit_vals, dtype=float)
+
+    # Infinite scores take the whole share and NaN counts as the weakest score
+    finite = np.isfinite(weights)
+    if not finite.all():
+        if np.isposinf(weights).any():
+            weights = np.isposinf(weights).astype(float)
+        else:
+            weights = np.where(finite, weights, weights[finite].min() if finite.any() else 0.0)
+
+    # Scale the scores down so shifting and summing them cannot overflow
+    scale = np.abs(weights).max()
+    if scale > 0:
+        weights = weights / scale
+
+    # Shift negative scores up so every weight is at least zero
+    lowest = weights.min()
+    if lowest < 0:
+        weights = weights - lowest
+
+    # Give every state a share when fewer than two can be picked
+    if np.count_nonzero(weights > 0) < 2:
+        weights = weights + (weights.sum() or 1.0) / len(weights)
+
+    table = np.cumsum(weights)
+    return table / table[-1]
+
+
+# Draw parent index pairs for a whole generation from the fitness of each state
+def select_pairs(fit_vals, pair_count, stats=None):
+    if len(fit_vals) < 2:
+        raise ValueError("selection needs at least two states")
+    table = get_selection_table(fit_vals)
+
+    first = np.searchsorted(table, np.random.random(pair_count), side='right')
+    second = np.searchsorted(table, np.random.random(pair_count), side='right')
+
+    # Redraw the second parent wherever it matches the first, a few times at most before
+    # taking any other state at random
+    clashes = np.flatnonzero(first == second)
+    for attempt in range(SELECTION_ATTEMPTS):
+        if len(clashes) == 0:
+            break
+        if stats is not None:
+            stats.count('selection_retries', len(clashes))
+        second[clashes] = np.searchsorted(table, np.random.random(len(clashes)), side='right')
+        clashes = clashes[first[clashes] == second[clashes]]
+    count = len(fit_vals)
+    second[clashes] = (first[clashes] + np.random.randint(1, count, size=len(clashes))) % count
+
+    return np.stack((first, second), axis=1)
+
+
+# Draw parent index pairs where each parent is the fittest of TOURNAMENT_SIZE states picked at random.
+# All entrants of a generation come from one call, the second parent's are drawn from every state but
+# the first parent so the two always differ without redrawing
+def tournament_pairs(fit_vals, pair_count, stats=None):
+    fit_vals = np.asarray(fit_vals, dtype=float)
+    count = len(fit_vals)
+    if count < 2:
+        raise ValueError("selection needs at least two states")
+    entrants = (np.random.random((2, pair_count, TOURNAMENT_SIZE)) * [[[count]], [[count - 1]]]).astype(np.intp)
+
+    first = tournament_winners(fit_vals, entrants[0])
+    others = entrants[1]
+    others += others >= first[:, None]
+    return np.stack((first, tournament_winners(fit_vals, others)), axis=1)
+
+
+# The fittest entrant of each row of tournaments
+def tournament_winners(fit_vals, entrants):
+    return np.take_along_axis(entrants, np.argmax(fit_vals[entrants], axis=1)[:, None], axis=1)[:, 0]
+
+
+# Draw parent index pairs with chances rising linearly with fitness rank, RANK_PRESSURE times the
+# average for the fittest and 2 - RANK_PRESSURE times it for the weakest, so raw scores and their sign
+# never matter. The second parent is drawn with the first parent's share cut out of the table, so both
+# come from one call and always differ
+def rank_pairs(fit_vals, pair_count, stats=None):
+    count = len(fit_vals)
+    if count < 2:
+        raise ValueError("selection needs at least two states")
+    chances = np.empty(count)
+    chances[np.argsort(fit_vals, kind='stable')] = \
+        (2 - RANK_PRESSURE + 2 * (RANK_PRESSURE - 1) * np.arange(count) / (count - 1)) / count
+    table = np.cumsum(chances)
+    table /= table[-1]
+    draws = np.random.random((2, pair_count))
+
+    first = np.minimum(np.searchsorted(table, draws[0], side='right'), count - 1)
+    share = chances[first]
+    second = draws[1] * (1 - share)
+    second += (second >= table[first] - share) * share
+    second = np.minimum(np.searchsorted(table, second, side='right'), count - 1)
+    # Rounding can leave a draw on the edge of the cut out share
+    second = np.where(second == first, (first + 1) % count, second)
+    return np.stack((first, second), axis=1)
+
+
+# Parent selection strategies by name, each drawing the parent index pairs of a whole generation
+SELECTIONS = {'roulette': select_pairs, 'tournament': tournament_pairs, 'rank': rank_pairs}
+
+
+# Base for problems keeping their population in a list, see GeneticAlgorithm for the batch
+# operators subclasses supply, key(state) gives a hashable copy of a genome to spot clones.
+# Seed states are copied into the first population and every restart
+class Problem:
+    sample_size = 0
+    elite_num = 0
+    culling_num = 0
+    max_sample_size = None
+    seeds = ()
+
+    # Change the sample size, with elitism and culling at the given fractions of it or else at
+    # the fractions they are now
+    def resize(self, sample_size, elite_fraction=None, culling_fraction=None):
+        if elite_fraction is None:
+            elite_fraction = self.elite_num / self.sample_size
+        if culling_fraction is None:
+            culling_fraction = self.culling_num / self.sample_size
+        self.sample_size = sample_size
+        self.elite_num = round(sample_size * elite_fraction)
+        self.culling_num = round(sample_size * culling_fraction)
+
+    def take(self, population, indexes):
+        return [population[index] for index in indexes]
+
+    def replace(self, population, indexes, states):
+        for index, state in zip(indexes, states):
+            population[index] = state
+        return population
+
+    # Store a generation is written into, with room for one state more than the sample size
+    # since children come in pairs
+    def buffer(self, population):
+        return [None] * (self.sample_size + 1)
+
+    # Write the states at the given indexes of population to the front of buffer
+    def take_into(self, population, indexes, buffer):
+        buffer[:len(indexes)] = [population[index] for index in indexes]
+
+    # Write states into buffer from start on
+    def store(self, buffer, start, states):
+        buffer[start:start + len(states)] = states
+
+    # Slots of buffer crossover_batch can write count children into, None when children are
+    # new objects that are stored afterwards
+    def slots(self, buffer, start, count):
+        return None
+
+    # The first count states of buffer as a population
+    def view(self, buffer, count):
+        return buffer[:count]
+
+    # Indexes of the states repeating an earlier state
+    def duplicates(self, population):
+        index = GenomeIndex(self.key)
+        return np.array([position for position, state in enumerate(population) if not index.add(state)],
+                        dtype=np.intp)
+
+    # Replace the states at the given indexes with new states so the population keeps its size
+    def drop(self, population, indexes):
+        return self.replace(population, indexes, self.init_population(len(indexes)))
+
+    def copy_state(self, state):
+        return copy.copy(state)
+
+    # The answer a state stands for, as shown to the user
+    def solution(self, state):
+        return state
+
+
+# Base for problems keeping their population in one numpy array, decode(population)
+# gives the arrays compared to spot clones
+class ArrayProblem(Problem):
+    def take(self, population, indexes):
+        return population[indexes]
+
+    def replace(self, population, indexes, states):
+        population[indexes] = states
+        return population
+
+    def buffer(self, population):
+        return np.empty((self.sample_size + 1,) + population.shape[1:], dtype=population.dtype)
+
+    # Indexes are always in range, and clip mode lets np.take write straight into out
+    def take_into(self, population, indexes, buffer):
+        np.take(population, indexes, axis=0, out=buffer[:len(indexes)], mode='clip')
+
+    def store(self, buffer, start, states):
+        buffer[start:start + len(states)] = states
+
+    def slots(self, buffer, start, count):
+        return buffer[start:start + count]
+
+    def view(self, buffer, count):
+        return buffer[:count]
+
+    def duplicates(self, population):
+        return duplicate_rows(self.decode(population))
+
+    def decode(self, population):
+        return population
+
+    # Replace the rows at the given indexes with new states so the array keeps its size
+    def drop(self, population, indexes):
+        population[indexes] = self.init_population(len(indexes))
+        return population
+
+    def copy_state(self, state):
+        return state.copy()
+
+
+# Generation loop shared by every problem. The problem holds sample_size, elite_num and
+# culling_num and works on whole populations at once through
+#   init_population(n)                           n new random states
+#   fitness_batch(population)                    the fitness of every state
+#   crossover_batch(population, pairs, out)      children of each (first, second) pair of indexes,
+#                                                written into out when slots gives one
+#   mutate_batch(population, mask, chance=None)  mutate by chance, in place, the states where mask
+#                                                is set, at the problem's own rate unless given
+#   snapshot(...) and restore(snapshot)          checkpoints, see start and snapshot below
+# along with the helpers of Problem or ArrayProblem. The population lives in one of two
+# preallocated buffers and each generation is written into the other before they swap. The
+# elites are copied in by index, so array problems never share a row between generations while
+# list problems carry the same state objects over, which is safe since elites are never mutated
+class GeneticAlgorithm:
+    def __init__(self, problem, stats=None, duplicates='drop', selection='roulette'):
+        self.problem = problem
+        self.stats = NullStats() if stats is None else stats
+        self.duplicates = duplicates
+        self.select_pairs = SELECTIONS[selection]
+        self.population = None
+        self.front = None
+        self.back = None
+        self.ranking = None
+        self.diversity = 1.0
+        self.generation = 0
+        self.best = None
+        self.best_fitness = None
+        self.best_generation = 0
+        self.step_seconds = None
+
+    # Start from a new random population, or from a checkpoint snapshot. Given a finite deadline,
+    # a new population is made and evaluated in at least OFFSPRING_CHUNKS chunks, each taking
+    # about OVERRUN_FRACTION of the time left at most, and cut short at two states or more once
+    # the deadline passes
+    def start(self, snapshot=None, deadline=None):
+        problem = self.problem
+        if deadline is not None and not math.isfinite(deadline):
+            deadline = None
+        # No generation has been timed yet
+        self.step_seconds = None
+        if snapshot is not None:
+            self.population, self.best, self.best_fitness, self.generation, self.best_generation = \
+                problem.restore(snapshot)
+            self.front = problem.buffer(self.population)
+            self.back = problem.buffer(self.population)
+            problem.store(self.front, 0, self.population)
+            self.population = problem.view(self.front, len(self.population))
+            self.rank()
+            return
+
+        start_time = time.time()
+        chunk = problem.sample_size
+        if deadline is not None:
+            chunk = max(2, math.ceil(problem.sample_size / OFFSPRING_CHUNKS))
+        states = self.new_states(min(chunk, problem.sample_size))
+        self.front = problem.buffer(states)
+        self.back = problem.buffer(states)
+        count = 0
+        fit_vals = []
+        while True:
+            problem.store(self.front, count, states)
+            fit_vals.append(np.asarray(problem.fitness_batch(problem.view(self.front, count + len(states))[count:]),
+                                       dtype=float))
+            count += len(states)
+            if count >= problem.sample_size:
                 break
+            if deadline is not None:
+                now = time.time()
+                if now >= deadline:
+                    break
+                # Size the next chunk from the time each state has taken so far
+                state_seconds = (now - start_time) / count
+                if state_seconds > 0:
+                    chunk = max(1, min(chunk, int(OVERRUN_FRACTION * (deadline - now) / state_seconds)))
+            states = problem.init_population(min(chunk, problem.sample_size - count))
+        if count < problem.sample_size:
+            problem.resize(count)
+        self.population = problem.view(self.front, count)
+        self.ranking = Ranking(np.concatenate(fit_vals))
+        self.stats.count('fitness_calls', count)
+        self.stats.lap('rank')
+        self.track_best()
+
+    # count new random states, starting with copies of the problem's seed states
+    def new_states(self, count):
+        problem = self.problem
+        states = problem.init_population(count)
+        seeds = problem.seeds[:count]
+        if len(seeds) > 0:
+            states = problem.replace(states, np.arange(len(seeds)), [problem.copy_state(seed) for seed in seeds])
+        return states
+
+    # Snapshot of the run for checkpointing
+    def snapshot(self):
+        return self.problem.snapshot(self.population, self.best, self.best_fitness, self.generation,
+                                     self.best_generation)
+
+    def rank(self):
+        self.ranking = Ranking(self.problem.fitness_batch(self.population))
+        self.stats.count('fitness_calls', len(self.population))
+        self.stats.lap('rank')
+
+    # Remember the fittest state seen so far, returning whether it improved
+    def track_best(self):
+        index = self.ranking.best()
+        fit_val = self.ranking.fit_vals[index]
+        if self.best is not None and fit_val <= self.best_fitness:
+            return False
+        self.best = self.problem.copy_state(self.population[index])
+        self.best_fitness = fit_val
+        self.best_generation = self.generation
+        return True
+
+    # Produce the next generation, returning whether the best state improved. Given a finite
+    # deadline, a generation that cannot finish in time, or any generation until one has been
+    # timed, is built in at least OFFSPRING_CHUNKS chunks, each taking about OVERRUN_FRACTION of
+    # the time left at most, and given up once the deadline passes, leaving the population as it was
+    def step(self, deadline=None):
+        problem = self.problem
+        if deadline is not None and not math.isfinite(deadline):
+            deadline = None
+        step_start = time.time()
+        self.stats.start()
+        # The sample size may have changed since the buffers were made
+        if len(self.back) != problem.sample_size + 1:
+            self.back = problem.buffer(self.population)
+
+        # Elitism and culling, always leaving the elites to choose parents from
+        elites = self.ranking.top(problem.elite_num)
+        survivors = self.ranking.survivors(min(problem.culling_num, len(self.ranking) - len(elites)))
+        problem.take_into(self.population, elites, self.back)
+        self.stats.lap('elitism')
+
+        # Get parents (selection) and create offspring (crossover) behind the elites
+        child_count = problem.sample_size - len(elites)
+        pairs = survivors[self.select_pairs(self.ranking.fit_vals[survivors], math.ceil(child_count / 2), self.stats)]
+        self.stats.lap('selection')
+        chunk = len(pairs)
+        if deadline is not None and self.step_seconds is None:
+            chunk = max(1, math.ceil(len(pairs) / OFFSPRING_CHUNKS))
+        elif deadline is not None and self.step_seconds > 0 and step_start + self.step_seconds >= deadline:
+            share = min(1 / OFFSPRING_CHUNKS, OVERRUN_FRACTION * (deadline - step_start) / self.step_seconds)
+            chunk = max(1, math.ceil(len(pairs) * share))
+        for start in range(0, len(pairs), max(chunk, 1)):
+            if chunk < len(pairs) and time.time() >= deadline:
+                self.stats.lap('crossover')
+                return False
+            out = problem.slots(self.back, len(elites) + 2 * start, 2 * len(pairs[start:start + chunk]))
+            children = problem.crossover_batch(self.population, pairs[start:start + chunk], out)
+            if out is None:
+                problem.store(self.back, len(elites) + 2 * start, children)
+        next_pop = problem.view(self.back, problem.sample_size)
+        self.stats.lap('crossover')
+
+        # Apply chance mutations to everything but the elites carried over
+        mask = np.ones(len(next_pop), dtype=bool)
+        mask[:len(elites)] = False
+        problem.mutate_batch(next_pop, mask)
+        self.stats.lap('mutation')
+
+        # Deal with clones before they are evaluated
+        next_pop = self.remove_duplicates(next_pop)
+        self.stats.lap('duplicates')
+        if deadline is not None and time.time() >= deadline:
+            return False
+
+        self.front, self.back = self.back, self.front
+        self.population = next_pop
+        self.generation += 1
+        self.rank()
+        self.step_seconds = time.time() - step_start
+        return self.track_best()
+
+    # Drop, re-mutate or keep clones as the duplicates policy says, the first copy of each
+    # genome is kept so the elites placed first always survive
+    def remove_duplicates(self, population):
+        repeated = self.problem.duplicates(population)
+        self.stats.count('duplicates', len(repeated))
+        self.diversity = 1 - len(repeated) / len(population)
+        if self.duplicates == 'mutate':
+            for attempt in range(DUPLICATE_ATTEMPTS):
+                if len(repeated) == 0:
+                    break
+                mask = np.zeros(len(population), dtype=bool)
+                mask[repeated] = True
+                self.problem.mutate_batch(population, mask, 1.0)
+                repeated = self.problem.duplicates(population)
+        elif self.duplicates == 'drop' and len(repeated) > 0:
+            population = self.problem.drop(population, repeated)
+        return population
+
+    # Start over around the elites
+    def restart(self):
+        problem = self.problem
+        if len(self.back) != problem.sample_size + 1:
+            self.back = problem.buffer(self.population)
+        elites = self.ranking.top(problem.elite_num)
+        problem.take_into(self.population, elites, self.back)
+        problem.store(self.back, len(elites), self.new_states(problem.sample_size - len(elites)))
+        self.front, self.back = self.back, self.front
+        self.population = problem.view(self.front, problem.sample_size)
+        self.rank()
+
+    # The fittest states, to send to another population
+    def emigrants(self, count):
+        return self.problem.take(self.population, self.ranking.top(count))
+
+    # Take in states from another population in place of the weakest
+    def immigrate(self, states):
+        self.population = self.problem.replace(self.population, self.ranking.bottom(len(states)), states)
+        self.rank()
+        self.track_best()
+
+    # Evolve until the deadline or max_generations, returning the best solution, its fitness,
+    # the generations run and the generation it was found on. A scheduler may resize the
+    # problem to fit the time left
+    def run(self, deadline, reporter=None, max_generations=None, checkpoint=None, stall=None, on_stall='stop',
+            on_improve=None, scheduler=None):
+        if reporter is None:
+            reporter = NullReporter()
+        if scheduler is not None:
+            scheduler.start(deadline)
+        while time.time() < deadline and self.generation != max_generations:
+            if self.step(deadline) and on_improve is not None:
+                on_improve(self.problem.solution(self.best), self.best_fitness, self.generation)
+            if scheduler is not None:
+                scheduler.update(self)
+            reporter.update(self.generation, self.problem.solution(self.best), self.best_fitness,
+                            self.best_generation, self.diversity)
+            self.stats.lap('report')
+
+            # Stop or start over around the elites once the run has stalled
+            if stall is not None and stall.update(self.generation, self.best_fitness, lambda: self.diversity):
+                if on_stall == 'stop':
+                    break
+                self.restart()
+                stall.reset(self.generation)
+                self.stats.count('restarts')
+
+            if checkpoint is not None and checkpoint.due():
+                checkpoint.save(self.snapshot())
+                self.stats.lap('checkpoint')
 
-    return parents
+        if checkpoint is not None:
+            checkpoint.save(self.snapshot())
+        return self.problem.solution(self.best), self.best_fitness, self.generation, self.best_generation
@@ -0,0 +1,175 @@
+import random
+import time
+from multiprocessing import Process, Queue
+from queue import Empty
+
+import numpy as np
+
+import NumberAllocation
+import TowerBuilding
+from ga_utils import GeneticAlgorithm, PhaseStats
+
+# Constants
+RESULT_SECONDS = 0.5
+
+
+# Island running the number allocation loop on any of the engines
+class AllocationIsland:
+    def __init__(self, file, stats=None, engine='classic', bins=NumberAllocation.BINS, duplicates='drop',
+                 selection='roulette', operators='valid', exact='off'):
+        number_list = NumberAllocation.number_allocation_parser(file)
+        problem = NumberAllocation.ENGINES[engine](number_list, bins=bins, stats=stats)
+        self.ga = GeneticAlgorithm(problem, stats, duplicates, selection)
+        self.ga.start()
+
+    def evolve(self):
+        self.ga.step()
+
+    def emigrants(self, count):
+        return np.array(self.ga.emigrants(count))
+
+    def immigrate(self, states):
+        self.ga.immigrate([state.copy() for state in states])
+
+    def best(self):
+        return self.ga.problem.solution(self.ga.best).copy(), self.ga.best_fitness
+
+
+# Island running the tower building loop, towers travel as tuples of piece ids. The fitness
+# is given without the offset keeping it positive, as the score of the tower
+class TowerIsland:
+    def __init__(self, file, stats=None, engine='classic', bins=NumberAllocation.BINS, duplicates='drop',
+                 selection='roulette', operators='valid', exact='off'):
+        self.pieces = TowerBuilding.towerBuildingParser(file)
+        bestTower = TowerBuilding.exactTower(self.pieces) if exact != 'off' else None
+        problem = TowerBuilding.TowerProblem(self.pieces, TowerBuilding.towerCache(), operators=operators,
+                                             seeds=[bestTower] if bestTower is not None else [])
+        self.ga = GeneticAlgorithm(problem, stats, duplicates, selection)
+        self.ga.start()
+
+    def evolve(self):
+        self.ga.step()
+
+    def emigrants(self, count):
+        return [TowerBuilding.towerKey(tower) for tower in self.ga.emigrants(count)]
+
+    def immigrate(self, states):
+        self.ga.immigrate([TowerBuilding.towerFromKey(self.pieces, key) for key in states])
+
+    def best(self):
+        return self.ga.best, self.ga.best_fitness - TowerBuilding.FITNESS
+
+
+ISLANDS = {1: AllocationIsland, 2: TowerIsland}
+
+
+# Get the islands each island sends its emigrants to
+def get_neighbours(index, island_num, topology):
+    if topology == 'ring':
+        return [(index + 1) % island_num] if island_num > 1 else []
+    return [other for other in range(island_num) if other != index]
+
+
+# Evolve one island, sending its result or the error that stopped it back to the parent
+def run_island(problem, file, run_time, index, inboxes, neighbours, interval, migration_size, results, profile,
+               options):
+    random.seed()
+    np.random.seed()
+    # Unread migrants left in a queue at the end must not block this process from exiting
+    for inbox in inboxes:
+        inbox.cancel_join_thread()
+    try:
+        results.put(evolve_island(problem, file, run_time, index, inboxes, neighbours, interval, migration_size,
+                                  profile, options))
+    except Exception as error:
+        results.put({'island': index, 'error': type(error).__name__ + ": " + str(error)})
+
+
+# Evolve one island, trading its best individuals with its neighbours every interval generations.
+# When profiling, the phase times and counters of the island are sent back with its result
+def evolve_island(problem, file, run_time, index, inboxes, neighbours, interval, migration_size, profile, options):
+    start = time.time()
+    stats = PhaseStats() if profile else None
+    island = ISLANDS[problem](file, stats, **options)
+    best_state, best_fitness = island.best()
+    generation = 0
+    best_generation = 0
+    received = 0
+
+    while run_time > (time.time() - start):
+        island.evolve()
+        generation += 1
+
+        # Send the best individuals out and take in whatever has arrived
+        if generation % interval == 0:
+            emigrants = island.emigrants(migration_size)
+            for neighbour in neighbours:
+                inboxes[neighbour].put(emigrants)
+            while True:
+                try:
+                    immigrants = inboxes[index].get_nowait()
+                except Empty:
+                    break
+                island.immigrate(immigrants)
+                received += len(immigrants)
+
+        curr_best_state, curr_best_fitness = island.best()
+        if curr_best_fitness > best_fitness:
+            best_state, best_fitness = curr_best_state, curr_best_fitness
+            best_generation = generation
+
+    return {
+        'island': index,
+        'best': best_state,
+        'best_fitness': best_fitness,
+        'generations': generation,
+        'best_generation': best_generation,
+        'received': received,
+        'times': stats.times if profile else None,
+        'counts': stats.counts if profile else None
+    }
+
+
+# Wait for the result of every island, standing in an error for any process that died without one
+def collect_results(processes, results):
+    island_stats = {}
+    while len(island_stats) < len(processes):
+        try:
+            island = results.get(timeout=RESULT_SECONDS)
+            island_stats[island['island']] = island
+        except Empty:
+            # An island exits cleanly only after sending its result, which is then already queued
+            for index, process in enumerate(processes):
+                if index not in island_stats and process.exitcode not in (None, 0):
+                    island_stats[index] = {'island': index, 'error': "exited with code " + str(process.exitcode)}
+    return [island_stats[index] for index in range(len(processes))]
+
+
+# Run several independent populations, one per process, with periodic migration. Options such as
+# the engine, bins, duplicates, selection, operators and exact are handed to every island, and
+# given stats the phase times and counters of every island are added to them
+def run_islands(problem, file, run_time, island_num=4, interval=10, migration_size=5, topology='ring', stats=None,
+                **options):
+    inboxes = [Queue() for _ in range(island_num)]
+    results = Queue()
+    processes = []
+    for index in range(island_num):
+        neighbours = get_neighbours(index, island_num, topology)
+        process = Process(target=run_island, args=(problem, file, run_time, index, inboxes, neighbours,
+                                                   interval, migration_size, results, stats is not None,
+                                                   options))
+        process.start()
+        processes.append(process)
+
+    # Collect results before joining so no process blocks on a full queue
+    island_stats = collect_results(processes, results)
+    for process in processes:
+        process.join()
+    for island in island_stats:
+        if 'error' in island:
+            raise RuntimeError("island " + str(island['island']) + " failed: " + island['error'])
+        if stats is not None:
+            stats.merge(island['times'], island['counts'])
+
+    best_stats = max(island_stats, key=lambda island: island['best_fitness'])
+    return best_stats, island_stats
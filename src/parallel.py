@@ -0,0 +1,75 @@
+import random
+from multiprocessing import Pool, get_start_method, resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+# State handed to each worker process once by the pool initializer
+worker_state = {}
+
+
+# Ndarray backed by shared memory so worker processes can read it without pickling
+class SharedArray:
+    def __init__(self, shape, dtype=float):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        size = max(1, int(np.prod(self.shape)) * self.dtype.itemsize)
+        self.memory = SharedMemory(create=True, size=size)
+        self.array = np.ndarray(self.shape, self.dtype, buffer=self.memory.buf)
+
+    def spec(self):
+        return self.memory.name, self.shape, self.dtype.str
+
+    def close(self):
+        self.array = None
+        self.memory.close()
+        self.memory.unlink()
+
+
+# Attach to a shared array created by the parent process
+def attach_shared(spec):
+    name, shape, dtype = spec
+    memory = SharedMemory(name=name)
+    # The parent owns the block, keep a spawned worker's own tracker from unlinking it on exit.
+    # Forked workers share the parent's tracker, which must keep the block registered
+    if get_start_method() == 'spawn':
+        resource_tracker.unregister(memory._name, 'shared_memory')
+    return memory, np.ndarray(shape, dtype, buffer=memory.buf)
+
+
+# Set up a worker process with its own random seed and the shared state
+def init_worker(state, shared_specs):
+    random.seed()
+    np.random.seed()
+    worker_state.update(state)
+    for key, spec in shared_specs.items():
+        memory, array = attach_shared(spec)
+        worker_state[key + '_memory'] = memory
+        worker_state[key] = array
+
+
+# Split items into at most count contiguous chunks of near equal size
+def split_chunks(items, count):
+    size = max(1, -(-len(items) // count))
+    return [items[index:index + size] for index in range(0, len(items), size)]
+
+
+# Process pool that hands work to its workers in one large chunk each
+class WorkerPool:
+    def __init__(self, workers, state=None, shared=None):
+        self.workers = workers
+        self.state = state or {}
+        self.shared = shared or {}
+        specs = {key: array.spec() for key, array in self.shared.items()}
+        self.pool = Pool(workers, init_worker, (self.state, specs))
+
+    def map_chunks(self, func, items):
+        if len(items) == 0:
+            return []
+        return self.pool.map(func, split_chunks(items, self.workers))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        for array in self.shared.values():
+            array.close()
@@ -0,0 +1,95 @@
+import json
+import queue
+import sys
+import threading
+import time
+
+
+# Reporter that drops every update, used when reporting is turned off
+class NullReporter:
+    def update(self, generation, best, best_fitness, found_generation, diversity=None):
+        pass
+
+    def close(self):
+        pass
+
+
+# Base for reporters that only act every few generations or seconds
+class RateLimitedReporter(NullReporter):
+    def __init__(self, every=None, seconds=None):
+        self.every = every
+        self.seconds = seconds
+        self.last_time = None
+
+    def due(self, generation):
+        if self.every and generation % self.every == 0:
+            return True
+        if self.seconds is not None:
+            now = time.monotonic()
+            if self.last_time is None or now - self.last_time >= self.seconds:
+                self.last_time = now
+                return True
+        return False
+
+
+# Human-readable reporter, printer(best, generation, found_generation) replaces the default line
+class TextReporter(RateLimitedReporter):
+    def __init__(self, every=None, seconds=None, printer=None):
+        super().__init__(every, seconds)
+        self.printer = printer
+
+    def update(self, generation, best, best_fitness, found_generation, diversity=None):
+        if not self.due(generation):
+            return
+        if self.printer is not None:
+            self.printer(best, generation, found_generation)
+        else:
+            print("Generation " + str(generation) + ": best fitness " + str(best_fitness) +
+                  " (found on " + str(found_generation) + ")" +
+                  (", diversity %.2f" % diversity if diversity is not None else ""))
+
+
+# Reporter streaming one JSON event per line, written by a background thread
+class JsonlReporter(RateLimitedReporter):
+    def __init__(self, path='-', every=None, seconds=None):
+        super().__init__(every, seconds)
+        self.file = sys.stdout if path == '-' else open(path, 'w')
+        self.events = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self.write_events, daemon=True)
+        self.thread.start()
+
+    def update(self, generation, best, best_fitness, found_generation, diversity=None):
+        if not self.due(generation):
+            return
+        event = {
+            'time': time.time(),
+            'generation': generation,
+            'best_fitness': float(best_fitness),
+            'found_generation': found_generation
+        }
+        if diversity is not None:
+            event['diversity'] = diversity
+        self.events.put(event)
+
+    def write_events(self):
+        while True:
+            event = self.events.get()
+            if event is None:
+                break
+            self.file.write(json.dumps(event) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.events.put(None)
+        self.thread.join()
+        if self.file is not sys.stdout:
+            self.file.close()
+
+
+# Build a reporter by name, report is one of 'none', 'text' or 'jsonl'
+def make_reporter(report, every=None, seconds=None, path='-', printer=None):
+    if report == 'text':
+        return TextReporter(every, seconds, printer)
+    if report == 'jsonl':
+        return JsonlReporter(path, every, seconds)
+    return NullReporter()
@@ -0,0 +1,270 @@
+import asyncio
+import itertools
+import json
+import os
+import random
+import signal
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import Manager
+
+import numpy as np
+
+import NumberAllocation
+import TowerBuilding
+from batch import describe_solution, detect_lines, run_instance
+from reporting import RateLimitedReporter
+
+# Constants
+PROGRESS_SECONDS = 1.0
+PARSED_SIZE = 16
+CANCEL_SECONDS = 0.05
+
+# Parsed inputs kept by each worker process, keyed on the path and modification time
+parsed_inputs = OrderedDict()
+
+
+# Reporter sending the progress of a job, with its best solution so far, back to the service
+class QueueReporter(RateLimitedReporter):
+    def __init__(self, events, job_id, problem, seconds=PROGRESS_SECONDS):
+        super().__init__(None, seconds)
+        self.events = events
+        self.job_id = job_id
+        self.problem = problem
+
+    def update(self, generation, best, best_fitness, found_generation, diversity=None):
+        if not self.due(generation):
+            return
+        if self.problem == 2:
+            best_fitness -= TowerBuilding.FITNESS
+        self.events.put({
+            'id': self.job_id,
+            'event': 'progress',
+            'generation': generation,
+            'best_fitness': float(best_fitness),
+            'found_generation': found_generation,
+            'diversity': diversity,
+            'solution': describe_solution(self.problem, best)
+        })
+
+
+# Stands in for a stall monitor to stop the generation loop once a job is cancelled, the flag
+# lives in the manager process so it is only asked every CANCEL_SECONDS
+class CancelMonitor:
+    def __init__(self, cancelled):
+        self.cancelled = cancelled
+        self.last_time = time.monotonic()
+
+    def update(self, generation, best_fitness, diversity=None):
+        now = time.monotonic()
+        if now - self.last_time < CANCEL_SECONDS:
+            return False
+        self.last_time = now
+        return self.cancelled.is_set()
+
+    def reset(self, generation):
+        pass
+
+
+# Give each worker its own random seed, forked workers would otherwise share one. Workers leave
+# interrupts to the service, which shuts them down itself
+def init_worker():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    random.seed()
+    np.random.seed()
+
+
+# Started on every worker when the service starts so the first jobs find the pool ready
+def warm_worker():
+    return os.getpid()
+
+
+# Parse the input of a job, inline as 'data' or read from 'file', telling the problem from it if not given.
+# Files are parsed once per worker until they change
+def load_job(job):
+    if 'data' in job:
+        text = job['data']
+        problem = job.get('problem') or detect_lines(text.splitlines())
+        if problem == 1:
+            return problem, NumberAllocation.parse_numbers(text)
+        return problem, TowerBuilding.parsePieces(text)
+
+    path = job['file']
+    key = (path, os.path.getmtime(path), job.get('problem'))
+    if key in parsed_inputs:
+        parsed_inputs.move_to_end(key)
+        return parsed_inputs[key]
+    with open(path, 'r') as f:
+        text = f.read()
+    problem = job.get('problem') or detect_lines(text.splitlines(), path)
+    if problem == 1:
+        parsed = problem, NumberAllocation.parse_numbers(text, path)
+    else:
+        parsed = problem, TowerBuilding.parsePieces(text, path)
+    parsed_inputs[key] = parsed
+    if len(parsed_inputs) > PARSED_SIZE:
+        parsed_inputs.popitem(last=False)
+    return parsed
+
+
+# Solve one job inside a worker process, streaming its progress and finally its result as events
+def solve_job(job, events, cancelled):
+    start = time.time()
+    result = {'id': job['id'], 'event': 'result', 'cancelled': False}
+    if cancelled.is_set():
+        result['cancelled'] = True
+        events.put(result)
+        return
+    events.put({'id': job['id'], 'event': 'started'})
+    try:
+        problem, instance = load_job(job)
+        result['problem'] = problem
+        reporter = QueueReporter(events, job['id'], problem, job.get('report_seconds', PROGRESS_SECONDS))
+        result.update(run_instance(problem, instance, float(job.get('time', 10)), job.get('engine', 'classic'),
+                                   reporter, CancelMonitor(cancelled), job.get('bins', NumberAllocation.BINS),
+                                   job.get('duplicates', 'drop'), job.get('operators', 'valid'),
+                                   job.get('selection', 'roulette')))
+        result['cancelled'] = cancelled.is_set()
+    except Exception as error:
+        result['error'] = type(error).__name__ + ": " + str(error)
+    result['seconds'] = time.time() - start
+    events.put(result)
+
+
+# A job on the service, the client writer its events go to and the flag that cancels it
+class Job:
+    def __init__(self, writer, cancelled):
+        self.writer = writer
+        self.cancelled = cancelled
+        self.future = None
+
+
+# Long-running solver taking jobs as JSON lines over a socket and running them on a warm process pool.
+# A request is {"id": ..., "file": path or "data": text, "time": seconds} with optional "problem",
+# "engine", "bins", "duplicates", "operators", "selection" and "report_seconds", or
+# {"op": "cancel", "id": ...}. Each job answers with queued, started and progress events and a final result event
+class SolverService:
+    def __init__(self, workers=1):
+        self.workers = workers
+        self.manager = Manager()
+        self.events = self.manager.Queue()
+        self.executor = ProcessPoolExecutor(workers, initializer=init_worker)
+        self.jobs = {}
+        self.ids = itertools.count(1)
+        self.loop = None
+
+    async def serve(self, address):
+        self.loop = asyncio.get_running_loop()
+        # Start every worker up front and forward worker events from a thread
+        await asyncio.gather(*(self.loop.run_in_executor(self.executor, warm_worker) for _ in range(self.workers)))
+        forwarder = threading.Thread(target=self.forward_events, daemon=True)
+        forwarder.start()
+
+        unix = ':' not in address or os.path.sep in address
+        if unix:
+            server = await asyncio.start_unix_server(self.handle, address)
+        else:
+            host, port = address.rsplit(':', 1)
+            server = await asyncio.start_server(self.handle, host, int(port))
+        print("Serving on " + address, flush=True)
+
+        # Run until interrupted or terminated
+        stopping = asyncio.Event()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(signum, stopping.set)
+        try:
+            async with server:
+                await stopping.wait()
+        finally:
+            self.close()
+            if unix and os.path.exists(address):
+                os.unlink(address)
+
+    # Read requests from one client until it disconnects, then cancel the jobs it left running
+    async def handle(self, reader, writer):
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+                if not isinstance(request, dict):
+                    raise ValueError("a request must be a JSON object")
+            except ValueError as error:
+                self.send(writer, {'event': 'error', 'error': str(error)})
+                continue
+            if request.get('op', 'solve') == 'cancel':
+                self.cancel(str(request.get('id')), writer)
+            else:
+                self.submit(request, writer)
+        for job_id, job in list(self.jobs.items()):
+            if job.writer is writer:
+                self.cancel(job_id, writer)
+        writer.close()
+
+    def submit(self, request, writer):
+        job_id = str(request['id']) if 'id' in request else str(next(self.ids))
+        if job_id in self.jobs:
+            self.send(writer, {'id': job_id, 'event': 'error', 'error': "job " + job_id + " is already running"})
+            return
+        if 'file' not in request and 'data' not in request:
+            self.send(writer, {'id': job_id, 'event': 'error', 'error': "a job needs a 'file' or 'data'"})
+            return
+        request['id'] = job_id
+        job = self.jobs[job_id] = Job(writer, self.manager.Event())
+        self.send(writer, {'id': job_id, 'event': 'queued'})
+        job.future = self.executor.submit(solve_job, request, self.events, job.cancelled)
+        job.future.add_done_callback(lambda future: self.loop.call_soon_threadsafe(self.finished, job_id, future))
+
+    # Cancel a job, one still queued never starts and a running one stops after its current generation
+    def cancel(self, job_id, writer):
+        job = self.jobs.get(job_id)
+        if job is None:
+            self.send(writer, {'id': job_id, 'event': 'error', 'error': "no job " + job_id})
+            return
+        job.cancelled.set()
+        job.future.cancel()
+
+    # Jobs that run send their own result event, only jobs cancelled while queued or lost with
+    # their worker are answered here
+    def finished(self, job_id, future):
+        if future.cancelled():
+            self.dispatch({'id': job_id, 'event': 'result', 'cancelled': True})
+        elif future.exception() is not None:
+            error = future.exception()
+            self.dispatch({'id': job_id, 'event': 'result', 'cancelled': False,
+                           'error': type(error).__name__ + ": " + str(error)})
+
+    def forward_events(self):
+        while True:
+            event = self.events.get()
+            if event is None:
+                break
+            self.loop.call_soon_threadsafe(self.dispatch, event)
+
+    # Send an event to the client of its job, forgetting the job once its result is sent
+    def dispatch(self, event):
+        job = self.jobs.get(event['id'])
+        if job is None:
+            return
+        if event['event'] == 'result':
+            del self.jobs[event['id']]
+        self.send(job.writer, event)
+
+    def send(self, writer, event):
+        if not writer.is_closing():
+            writer.write((json.dumps(event) + '\n').encode())
+
+    def close(self):
+        for job in self.jobs.values():
+            job.cancelled.set()
+        self.executor.shutdown(cancel_futures=True)
+        self.events.put(None)
+        self.manager.shutdown()
+
+
+# Serve jobs on address, host:port or the path of a Unix socket, until interrupted or terminated
+def serve(address, workers=1):
+    asyncio.run(SolverService(workers).serve(address))